@@ -0,0 +1,148 @@
+import os
+import cv2
+import json
+import time
+import torch
+import numpy as np
+import multiprocessing as mp
+
+from tqdm import tqdm
+from option import args
+from test import Test
+from utils import get_device
+
+# shards per worker, smaller shards let the workers even out pairs of different sizes
+SHARDS_PER_WORKER = 4
+
+# the Test of a worker process, loaded once by init_worker
+_test = None
+
+
+def init_worker(counter, threads):
+    """
+    Pool initializer: fix the thread budget of the process and load the model once for all its shards
+    """
+    global _test
+    with counter.get_lock():
+        worker_id = counter.value
+        counter.value += 1
+    # ONNX Runtime sessions read their budget from args, torch has been set up by get_device() already
+    args.num_threads = threads
+    args.num_interop_threads = 1
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        print('[WARNING] inter-op threads of worker %d were already set' % worker_id)
+    # a worker takes exactly its budget: pairs are decoded and written inline, the other processes
+    # overlap with it, and cv2 starts no pool of its own
+    args.decode_threads = 0
+    args.encode_threads = 0
+    cv2.setNumThreads(1)
+    if get_device().type == 'cuda' and get_device().index is None:
+        torch.cuda.set_device(worker_id % torch.cuda.device_count())
+
+    start_time = time.time()
+    _test = Test()
+    _test.worker_id = worker_id
+    _test.load_time = time.time() - start_time
+
+
+def fuse_shard(indices):
+    _test.test_time = []
+    wall_time = _test.run(indices, progress=False)
+    return {'worker': _test.worker_id, 'load_time': _test.load_time, 'pairs': len(indices), 'wall_time': wall_time,
+            'model_times': _test.test_time}
+
+
+def shards(num_imgs, num_shards):
+    """
+    contiguous ranges of the sorted pair list
+    """
+    bounds = np.linspace(0, num_imgs, num_shards + 1).astype(int)
+    return [range(begin, end) for begin, end in zip(bounds[:-1], bounds[1:]) if end > begin]
+
+
+def merge(results, workers, threads, total_time):
+    """
+    one report over the shard results: per worker and overall throughput, per pair latency
+    """
+    per_worker = {}
+    for result in results:
+        entry = per_worker.setdefault(result['worker'], {'worker': result['worker'], 'load_time': result['load_time'],
+                                                         'shards': 0, 'pairs': 0, 'busy_time': 0., 'model_time': 0.})
+        entry['shards'] += 1
+        entry['pairs'] += result['pairs']
+        entry['busy_time'] += result['wall_time']
+        entry['model_time'] += float(np.sum(result['model_times']))
+    per_worker = [per_worker[k] for k in sorted(per_worker)]
+    model_times = np.array([t for result in results for t in result['model_times']])
+    busy = np.array([entry['busy_time'] for entry in per_worker])
+    pairs = int(sum(entry['pairs'] for entry in per_worker))
+    return {'workers': workers, 'threads_per_worker': threads, 'pairs': pairs, 'total_time': total_time,
+            'throughput': pairs / total_time,
+            # leaves out the start of the processes and the model loads
+            'steady_throughput': pairs / busy.max(),
+            'imbalance': float(busy.max() / busy.mean()),
+            'latency_mean': float(model_times.mean()), 'latency_p50': float(np.percentile(model_times, 50)),
+            'latency_p95': float(np.percentile(model_times, 95)),
+            'per_worker': per_worker}
+
+
+def print_report(report):
+    print('%6s %7s %7s %10s %10s %11s %10s' % ('worker', 'shards', 'pairs', 'load (s)', 'busy (s)', 'model (s)',
+                                               'images/s'))
+    for entry in report['per_worker']:
+        print('%6d %7d %7d %10.2f %10.2f %11.2f %10.2f' % (
+            entry['worker'], entry['shards'], entry['pairs'], entry['load_time'], entry['busy_time'],
+            entry['model_time'], entry['pairs'] / entry['busy_time']))
+    print('%d pairs on %d workers x %d threads in %.2f s, busiest worker %.2fx the mean' % (
+        report['pairs'], report['workers'], report['threads_per_worker'], report['total_time'], report['imbalance']))
+    print('The average testing time is {:.4f} s (p50 {:.4f} s, p95 {:.4f} s).'.format(
+        report['latency_mean'], report['latency_p50'], report['latency_p95']))
+    print('Throughput: {:.2f} images/s end to end, {:.2f} images/s once the workers are loaded.'.format(
+        report['throughput'], report['steady_throughput']))
+
+
+def batch_fusion():
+    """
+    fuse every pair of dir_test into save_dir like Test, with the sorted pair list split into shards
+    over --fusion_workers processes of --worker_threads threads each, decoding and writing included,
+    --decode_threads and --encode_threads do not apply. Every process loads the model
+    (or --artifact) once and takes shards until none are left, the timings of all are merged into one
+    report, also written to --fusion_report
+    """
+    num_imgs = len(os.listdir(args.dir_test + 'lr_over/'))
+    threads = max(1, args.worker_threads)
+    workers = args.fusion_workers if args.fusion_workers > 0 else max(1, (os.cpu_count() or 1) // threads)
+    workers = max(1, min(workers, num_imgs))
+    if args.profile:
+        print('[WARNING] --profile is not supported by --batch_fusion, run --test_only on a subset')
+        args.profile = False
+
+    print('===> Fusing %d pairs on %d workers x %d threads' % (num_imgs, workers, threads))
+    ctx = mp.get_context('spawn')
+    counter = ctx.Value('i', 0)
+    results = []
+    start_time = time.time()
+    with ctx.Pool(workers, initializer=init_worker, initargs=(counter, threads)) as pool, \
+            tqdm(total=num_imgs) as bar:
+        for result in pool.imap_unordered(fuse_shard, shards(num_imgs, workers * SHARDS_PER_WORKER)):
+            results.append(result)
+            bar.update(result['pairs'])
+        # let the workers exit on their own instead of the terminate() of the context exit
+        pool.close()
+        pool.join()
+    total_time = time.time() - start_time
+
+    report = merge(results, workers, threads, total_time)
+    print_report(report)
+    if args.fusion_report:
+        with open(args.fusion_report, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('===> Saved %s' % args.fusion_report)
+    return report
+
+
+if __name__ == '__main__':
+    batch_fusion()
@@ -0,0 +1,86 @@
+import os
+import cv2
+import math
+import torch
+import numpy as np
+import torchvision.transforms as transforms
+
+from option import args
+from model import CFNet
+from perceived_loss import PerceptualLoss
+from train import fusion_loss
+from utils import get_device, memory_format, to_device, autocast, grad_scaler, timeit
+
+
+def psnr(img1, img2):
+    mse = np.mean((img1 / 255. - img2 / 255.) ** 2)
+    return 20 * math.log10(1. / math.sqrt(mse))
+
+
+def main():
+    """
+    fp32 vs --precision: PSNR on dir_val and training step time
+    """
+    device = get_device()
+    precision = args.precision if args.precision != 'fp32' else 'bf16' if device.type == 'cpu' else 'fp16'
+    print('===> Comparing fp32 with %s on %s' % (precision, device))
+
+    model = CFNet()
+    if os.path.exists(args.model_path + args.model):
+        model.load_state_dict(torch.load(args.model_path + args.model, map_location='cpu')['model'])
+    else:
+        print('[WARNING] %s not found, using random weights' % (args.model_path + args.model))
+    model = model.to(device, memory_format=memory_format(device))
+
+    # validation PSNR
+    model.eval()
+    transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=[0.5, 0.5, 0.5],
+                                                                                std=[0.5, 0.5, 0.5])])
+    overs = sorted(os.listdir(args.dir_val + 'lr_over/'))
+    unders = sorted(os.listdir(args.dir_val + 'lr_under/'))
+    gts = sorted(os.listdir(args.dir_val + 'gt/'))
+    assert len(overs) == len(unders) == len(gts)
+    rows = []
+    with torch.no_grad():
+        for over, under, name in zip(overs, unders, gts):
+            img1 = to_device(transform(cv2.imread(args.dir_val + 'lr_over/' + over)).unsqueeze(0), device)
+            img2 = to_device(transform(cv2.imread(args.dir_val + 'lr_under/' + under)).unsqueeze(0), device)
+            img_gt = cv2.imread(args.dir_val + 'gt/' + name)
+            fused = {}
+            for p in ('fp32', precision):
+                with autocast(device, p):
+                    sr_over, sr_under = model(img1, img2, outputs='sr')
+                img_fused = (0.5 * sr_over + 0.5 * sr_under).squeeze(0).float().cpu().numpy()
+                fused[p] = np.transpose(img_fused, (1, 2, 0)).astype(np.uint8)
+            # the ground truth is only comparable when the network reproduces its size
+            gt_psnr = [psnr(fused[p], img_gt) if fused[p].shape == img_gt.shape else float('nan')
+                       for p in ('fp32', precision)]
+            rows.append(gt_psnr + [psnr(fused[precision], fused['fp32'])])
+            print('%-20s PSNR fp32 %.2f dB, %s %.2f dB, %s vs fp32 %.2f dB' % ((name, gt_psnr[0], precision)
+                                                                               + (gt_psnr[1], precision, rows[-1][2])))
+    print('mean PSNR fp32 %.2f dB, %s %.2f dB, %s vs fp32 %.2f dB' % (
+        np.mean([r[0] for r in rows]), precision, np.mean([r[1] for r in rows]), precision,
+        np.mean([r[2] for r in rows])))
+
+    # training step time on a random batch
+    model.train()
+    perceptual_loss = PerceptualLoss().to(device, memory_format=memory_format(device))
+    lr_size = (args.batch_size, 3, args.patch_size, args.patch_size)
+    hr_size = (args.batch_size, 3, args.patch_size * args.scale, args.patch_size * args.scale)
+    l_over, l_under = [to_device(torch.rand(lr_size) * 2 - 1, device) for _ in range(2)]
+    h_over, h_under, h = [to_device(torch.rand(hr_size) * 255, device) for _ in range(3)]
+    for p in ('fp32', precision):
+        scaler = grad_scaler(device, p)
+
+        def step():
+            model.zero_grad()
+            with autocast(device, p):
+                sr_over, sr_under, fusion = model(l_over, l_under)
+                loss = fusion_loss(sr_over, sr_under, fusion, h_over, h_under, h, perceptual_loss)
+            scaler.scale(loss).backward()
+
+        print('%-5s training step %.1f ms' % (p, timeit(step, device, warmup=1, repeat=5) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import sys
+import json
+import time
+import torch
+import platform
+
+from option import args
+from model import CFNet, FAC, DRB_CFBS
+from utils import get_device, memory_format, timeit, peak_memory
+
+# fields that identify a measurement across runs
+KEY = ('component', 'size', 'scale', 'num_groups', 'num_cfbs', 'threads')
+
+# components that only exist with at least this many CFBs
+CFBS_NEEDED = {'cfb': 1, 'cfnet_all': DRB_CFBS}
+
+
+def int_list(spec, default):
+    return [int(value) for value in spec.split(',') if value.strip()] if spec else [default]
+
+
+def components(model, lr):
+    """
+    name -> (prepare, run): prepare() builds the inputs of the component from the ones before it, run()
+    is what gets timed. Inputs are built lazily so that a component that fails for a configuration
+    (the DRB at --scale 4) does not take the others with it
+    """
+    inputs = {}
+
+    def f_in():
+        if 'f_in' not in inputs:
+            inputs['f_in'] = model.feat_in_over(model.conv_in_over(lr))
+        return inputs['f_in']
+
+    def g():
+        if 'g' not in inputs:
+            inputs['g'] = model.srb_1(f_in())
+        return inputs['g']
+
+    def drb(stage):
+        if stage < 0:
+            return model.img_upsample(lr)
+        if 'drb%d' % stage not in inputs:
+            inputs['drb%d' % stage] = model.drb_stage(drb(stage - 1), g(), g())
+        return inputs['drb%d' % stage]
+
+    def fac_inputs():
+        img = model.img_upsample(lr)
+        kernel = torch.randn(lr.size(0), model.kernel_dim * 4, img.size(2) // 2, img.size(3) // 2,
+                             device=lr.device).contiguous(memory_format=memory_format(lr.device))
+        return img, kernel
+
+    return {
+        'feb': (lambda: lr, lambda x: model.feat_in_over(model.conv_in_over(x))),
+        'srb': (f_in, lambda x: model.srb_1(x)),
+        'cfb': (lambda: (f_in(), g()), lambda x: model.CFBs_1[0](x[0], x[1], x[1])),
+        'drb0': (lambda: (drb(-1), g()), lambda x: model.drb_stage(x[0], x[1], x[1])),
+        'drb1': (lambda: (drb(0), g()), lambda x: model.drb_stage(x[0], x[1], x[1])),
+        'drb2': (lambda: (drb(1), g()), lambda x: model.drb_stage(x[0], x[1], x[1])),
+        'fac': (fac_inputs, lambda x: FAC(x[0], x[1], model.kernel_width)),
+        'rec': (g, lambda x: model.conv_out_over(model.out_over(x))),
+        'cfnet_sr': (lambda: lr, lambda x: model(x, x, outputs='sr')),
+        'cfnet_all': (lambda: lr, lambda x: model(x, x)),
+    }
+
+
+def run_suite(device):
+    results = []
+    threads_before = torch.get_num_threads()
+    # SRB and CFB read their configuration from args, put it back for whatever runs next
+    scale_before, num_groups_before = args.scale, args.num_groups
+    try:
+        for scale in int_list(args.bench_scales, args.scale):
+            for num_groups in int_list(args.bench_groups, args.num_groups):
+                for num_cfbs in int_list(args.bench_cfbs, args.num_cfbs):
+                    args.scale = scale
+                    args.num_groups = num_groups
+                    torch.manual_seed(args.seed)
+                    model = CFNet(upscale_factor=scale, num_cfbs=num_cfbs)
+                    model = model.to(device, memory_format=memory_format(device)).eval()
+                    for size in int_list(args.bench_sizes, args.patch_size):
+                        lr = (torch.rand(1, 3, size, size, device=device) * 2 - 1).contiguous(
+                            memory_format=memory_format(device))
+                        for threads in int_list(args.bench_threads, threads_before):
+                            torch.set_num_threads(threads)
+                            for name, (prepare, run) in components(model, lr).items():
+                                record = {'component': name, 'size': size, 'scale': scale,
+                                          'num_groups': num_groups, 'num_cfbs': num_cfbs, 'threads': threads}
+                                if num_cfbs < CFBS_NEEDED.get(name, 0):
+                                    record['skipped'] = 'needs %d CFBs' % CFBS_NEEDED[name]
+                                    print('%-10s %6d %6d %7d %5d %8d   skipped, %s' % tuple(
+                                        [record[k] for k in KEY] + [record['skipped']]))
+                                    results.append(record)
+                                    continue
+                                try:
+                                    with torch.no_grad():
+                                        x = prepare()
+                                        _, peak = peak_memory(lambda: run(x), device)
+                                        record['time_ms'] = timeit(lambda: run(x), device, warmup=1,
+                                                                   repeat=args.bench_repeat) * 1e3
+                                        record['peak_mb'] = peak / 2 ** 20
+                                    print('%-10s %6d %6d %7d %5d %8d %12.2f %12.1f' % tuple(
+                                        [record[k] for k in KEY] + [record['time_ms'], record['peak_mb']]))
+                                except RuntimeError as e:
+                                    record['error'] = str(e).split('\n')[0]
+                                    print('%-10s %6d %6d %7d %5d %8d   [WARNING] %s' % tuple(
+                                        [record[k] for k in KEY] + [record['error'][:60]]))
+                                results.append(record)
+    finally:
+        args.scale, args.num_groups = scale_before, num_groups_before
+        torch.set_num_threads(threads_before)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    print the time of every measurement against the baseline and return the regressions, those more
+    than `tolerance` slower
+    """
+    reference = {tuple(r[k] for k in KEY): r for r in baseline['results'] if 'time_ms' in r}
+    regressions = []
+    print('===> Against %s (tolerance %.0f%%)' % (args.bench_baseline, tolerance * 100))
+    for record in results:
+        base = reference.get(tuple(record[k] for k in KEY))
+        if base is None or 'time_ms' not in record:
+            continue
+        ratio = record['time_ms'] / base['time_ms']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = 'REGRESSION'
+            regressions.append(record)
+        elif ratio < 1 - tolerance:
+            flag = 'faster'
+        print('%-10s %6d %6d %7d %5d %8d %12.2f %12.2f %7.2fx %s' % tuple(
+            [record[k] for k in KEY] + [base['time_ms'], record['time_ms'], ratio, flag]))
+    return regressions
+
+
+def main():
+    """
+    latency and peak memory of every CFNet component in isolation and of the whole network, with
+    random weights, over the --bench_* sweeps. Results go to --bench_json and are checked against
+    --bench_baseline if given, a regression makes the exit status non-zero
+    """
+    device = get_device()
+    print('%-10s %6s %6s %7s %5s %8s %12s %12s' % ('component', 'size', 'scale', 'groups', 'cfbs', 'threads',
+                                                   'time (ms)', 'peak (MB)'))
+    results = run_suite(device)
+    report = {'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'torch': torch.__version__,
+                       'device': str(device), 'platform': platform.platform(), 'processor': platform.processor(),
+                       'num_features': args.num_features, 'repeat': args.bench_repeat},
+              'results': results}
+    with open(args.bench_json, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('===> Saved %s' % args.bench_json)
+
+    if args.bench_baseline:
+        with open(args.bench_baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.bench_tolerance)
+        if regressions:
+            print('[WARNING] %d measurements regressed' % len(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import torch
+import platform
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from option import args
+from model import CFNet
+from train import fusion_loss
+from perceived_loss import PerceptualLoss
+from torch.nn.parallel import DistributedDataParallel
+from benchmark_components import int_list
+
+WARMUP = 2
+
+
+def synthetic_batch(batch_size, patch_size, scale):
+    """
+    a training batch as MEFBatch.to() returns it: LR pair in [-1, 1], HR triple in [0, 255]
+    """
+    lr = [torch.rand(batch_size, 3, patch_size, patch_size) * 2 - 1 for _ in range(2)]
+    hr = [torch.rand(batch_size, 3, patch_size * scale, patch_size * scale) * 255 for _ in range(3)]
+    return lr + hr
+
+
+def worker(rank, procs, threads, port, queue):
+    torch.set_num_threads(threads)
+    if procs > 1:
+        dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port, world_size=procs, rank=rank)
+    torch.manual_seed(args.seed)
+    model = CFNet()
+    train_model = model
+    if procs > 1:
+        train_model = DistributedDataParallel(model, find_unused_parameters=True)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-6)
+    perceptual_loss = PerceptualLoss()
+
+    torch.manual_seed(args.seed + rank)
+    l_over, l_under, h_over, h_under, h = synthetic_batch(args.batch_size, args.patch_size, args.scale)
+    times = []
+    for step in range(WARMUP + args.bench_repeat):
+        if procs > 1:
+            # time the steps of all ranks from a common start
+            dist.barrier()
+        start_time = time.time()
+        optimizer.zero_grad()
+        sr_over, sr_under, fusion = train_model(l_over, l_under)
+        loss = fusion_loss(sr_over, sr_under, fusion, h_over, h_under, h, perceptual_loss)
+        loss.backward()
+        optimizer.step()
+        if step >= WARMUP:
+            times.append(time.time() - start_time)
+
+    if procs > 1:
+        # a step is as slow as its slowest rank
+        times = torch.tensor(times, dtype=torch.float64)
+        dist.all_reduce(times, op=dist.ReduceOp.MAX)
+        times = times.tolist()
+        dist.destroy_process_group()
+    if rank == 0:
+        queue.put(sorted(times)[len(times) // 2])
+
+
+def run(procs, port):
+    """
+    median time of a DDP training step with procs processes, each on its own batch_size patches and an
+    equal share of the cores
+    """
+    threads = args.num_threads if args.num_threads > 0 else max(1, (os.cpu_count() or 1) // procs)
+    queue = mp.get_context('spawn').SimpleQueue()
+    mp.spawn(worker, args=(procs, threads, port, queue), nprocs=procs, join=True)
+    return threads, queue.get()
+
+
+def main():
+    """
+    weak scaling of data-parallel training on one host over --bench_procs processes: the global batch
+    grows with the processes, batch_size patches of patch_size each, with random weights and data.
+    Results go to --bench_ddp_json
+    """
+    print('%6s %8s %12s %12s %9s %11s' % ('procs', 'threads', 'step (ms)', 'patches/s', 'speedup', 'efficiency'))
+    results = []
+    for i, procs in enumerate(int_list(args.bench_procs, 1)):
+        threads, step_time = run(procs, 29500 + i)
+        throughput = procs * args.batch_size / step_time
+        if not results:
+            base = throughput
+        record = {'procs': procs, 'threads': threads, 'step_ms': step_time * 1e3, 'patches_per_s': throughput,
+                  'speedup': throughput / base, 'efficiency': throughput / base / procs}
+        print('%6d %8d %12.1f %12.2f %8.2fx %10.0f%%' % (procs, threads, record['step_ms'], throughput,
+                                                         record['speedup'], record['efficiency'] * 100))
+        results.append(record)
+
+    report = {'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'torch': torch.__version__,
+                       'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'backend': 'gloo',
+                       'batch_size': args.batch_size, 'patch_size': args.patch_size, 'scale': args.scale,
+                       'num_features': args.num_features, 'repeat': args.bench_repeat},
+              'results': results}
+    with open(args.bench_ddp_json, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('===> Saved %s' % args.bench_ddp_json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import torch
+
+from option import args
+from model import SRB, CFB, _dense_projection_cat, _dense_projection_slab, compress
+from utils import get_device, memory_format, timeit, allocations
+
+# LR feature sizes and batch sizes swept
+SIZES = [(64, 64), (128, 128), (256, 256)]
+BATCHES = [1, 4]
+
+
+def main():
+    """
+    allocations and latency of the SRB/CFB projection groups and compress_out, concatenating vs
+    preallocated slabs, in the default memory format of the device and in NCHW
+    """
+    device = get_device()
+    blocks = {'SRB': SRB(None), 'CFB': CFB(None)}
+    formats = [memory_format(device)] + [torch.contiguous_format] * (memory_format(device) != torch.contiguous_format)
+    print('%-5s %-17s %-5s %-6s %12s %14s %12s %10s' % ('block', 'format', 'batch', 'impl', 'allocs', 'alloc (MB)',
+                                                        'time (ms)', 'max diff'))
+    with torch.no_grad():
+        for name, block in blocks.items():
+            for fmt in formats:
+                block = block.to(device, memory_format=fmt).eval()
+                impls = {'cat': lambda x, guide: block.compress_out(_dense_projection_cat(block, x, guide)),
+                         'slab': lambda x, guide: compress(block.compress_out, _dense_projection_slab(block, x, guide))}
+                for h, w in SIZES:
+                    for batch in BATCHES:
+                        x = torch.randn(batch, args.num_features, h, w, device=device).contiguous(memory_format=fmt)
+                        guide = x if name == 'CFB' else None
+                        ref = impls['cat'](x, guide)
+                        out = impls['slab'](x, guide)
+                        assert torch.allclose(ref, out, rtol=1e-4, atol=1e-5), \
+                            'slab output differs from the concatenating version'
+
+                        for impl, fn in impls.items():
+                            count, size = allocations(lambda: fn(x, guide), device)
+                            latency = timeit(lambda: fn(x, guide), device, warmup=1, repeat=5)
+                            diff = (ref - out).abs().max().item() if impl == 'slab' else 0.
+                            print('%-5s %-17s %-5d %-6s %12d %14.1f %12.2f %10.1e' % (
+                                name, str(fmt).split('.')[-1], batch, impl, count, size / 2 ** 20, latency * 1e3, diff))
+
+
+if __name__ == '__main__':
+    main()
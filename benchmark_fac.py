@@ -0,0 +1,43 @@
+import torch
+import numpy as np
+
+from model import FAC, FAC_unfold
+from utils import get_device, timeit, peak_memory
+
+# low-resolution kernel sizes, the feature map FAC filters is twice as large
+SIZES = [(64, 64), (128, 128), (256, 256), (512, 512)]
+KSIZE = 7
+
+
+def main():
+    device = get_device()
+    torch.manual_seed(0)
+    print('%-12s %-10s %12s %12s %12s' % ('size', 'impl', 'time (ms)', 'peak (MB)', 'max diff'))
+    with torch.no_grad():
+        for h, w in SIZES:
+            feat_in = torch.randn(1, 3, 2 * h, 2 * w, device=device)
+            kernel = torch.randn(1, KSIZE * KSIZE * 4, h, w, device=device)
+
+            ref, ref_peak = peak_memory(lambda: FAC_unfold(feat_in, kernel, KSIZE), device)
+            out, out_peak = peak_memory(lambda: FAC(feat_in, kernel, KSIZE), device)
+            diff = (ref - out).abs().max().item()
+            assert torch.allclose(ref, out, rtol=1e-4, atol=1e-4), 'FAC differs from FAC_unfold by %g' % diff
+            del ref, out
+
+            ref_time = timeit(lambda: FAC_unfold(feat_in, kernel, KSIZE), device, repeat=5)
+            out_time = timeit(lambda: FAC(feat_in, kernel, KSIZE), device, repeat=5)
+            size = '%dx%d' % (2 * h, 2 * w)
+            print('%-12s %-10s %12.2f %12.1f %12s' % (size, 'unfold', ref_time * 1e3, ref_peak / 2 ** 20, '-'))
+            print('%-12s %-10s %12.2f %12.1f %12.2e' % (size, 'taps', out_time * 1e3, out_peak / 2 ** 20, diff))
+
+    # gradients are recomputed tap by tap in the backward, check them too
+    feat_in = torch.randn(2, 3, 64, 64, device=device, dtype=torch.float64, requires_grad=True)
+    kernel = torch.randn(2, KSIZE * KSIZE * 4, 32, 32, device=device, dtype=torch.float64, requires_grad=True)
+    grad = torch.randn(2, 3, 32, 32, device=device, dtype=torch.float64)
+    ref = torch.autograd.grad(FAC_unfold(feat_in, kernel, KSIZE), (feat_in, kernel), grad)
+    out = torch.autograd.grad(FAC(feat_in, kernel, KSIZE), (feat_in, kernel), grad)
+    print('max grad diff: %.2e' % np.max([(r - o).abs().max().item() for r, o in zip(ref, out)]))
+
+
+if __name__ == '__main__':
+    main()
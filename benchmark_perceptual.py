@@ -0,0 +1,47 @@
+import torch
+
+from option import args
+from perceived_loss import PerceptualLoss
+from utils import get_device, memory_format, timeit, peak_memory
+
+# fusion batches swept, (batch size, HR patch size)
+SIZES = [(2, 64), (4, 128), (8, 128)]
+
+
+def main():
+    """
+    step time of the perceptual loss, forward and backward, prediction and target in one VGG pass
+    (concat) vs two (split)
+    """
+    device = get_device()
+    losses = {batching: PerceptualLoss(batching=batching).to(device, memory_format=memory_format(device))
+              for batching in ('split', 'concat')}
+    print('===> vgg19 features[:%d], %s normalization, on %s' % (args.vgg_layer, args.vgg_normalize, device))
+    print('%-12s %-8s %14s %12s %10s %12s' % ('batch', 'impl', 'loss', 'time (ms)', 'speedup', 'peak (MB)'))
+    for batch_size, size in SIZES:
+        real = (torch.rand(batch_size, 3, size, size, device=device) * 255).contiguous(
+            memory_format=memory_format(device))
+        predicted = (real + 20 * torch.randn_like(real)).requires_grad_()
+
+        results = {}
+        for batching, loss_fn in losses.items():
+            def step():
+                return torch.autograd.grad(loss_fn(predicted, real), predicted)[0]
+
+            grad, peak = peak_memory(step, device)
+            results[batching] = (loss_fn(predicted, real).item(), grad, timeit(step, device, warmup=1, repeat=5),
+                                 peak)
+
+        ref_loss, ref_grad, ref_time, ref_peak = results['split']
+        loss, grad, latency, peak = results['concat']
+        assert abs(loss - ref_loss) <= 1e-3 * abs(ref_loss), 'concat loss %g differs from %g' % (loss, ref_loss)
+        assert torch.allclose(grad, ref_grad, rtol=1e-3, atol=1e-6 * ref_grad.abs().max().item())
+        name = '%dx%d^2' % (batch_size, size)
+        print('%-12s %-8s %14.4f %12.2f %10s %12.1f' % (name, 'split', ref_loss, ref_time * 1e3, '',
+                                                        ref_peak / 2 ** 20))
+        print('%-12s %-8s %14.4f %12.2f %9.2fx %12.1f' % (name, 'concat', loss, latency * 1e3, ref_time / latency,
+                                                          peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
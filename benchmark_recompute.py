@@ -0,0 +1,40 @@
+import torch
+
+from option import args
+from model import CFNet, recompute_blocks
+from utils import get_device, memory_format, to_device, autocast, timeit, peak_memory
+
+# LR patch sizes and --recompute settings swept
+PATCH_SIZES = [32, 48, 64]
+SETTINGS = ['', 'srb', 'cfb', 'drb', 'all']
+
+
+def main():
+    """
+    peak training memory vs step time for every --recompute setting
+    """
+    device = get_device()
+    model = CFNet().to(device, memory_format=memory_format(device))
+    model.train()
+
+    print('%-8s %-10s %12s %12s' % ('patch', 'recompute', 'peak (MB)', 'step (ms)'))
+    for patch_size in PATCH_SIZES:
+        size = (args.batch_size, 3, patch_size, patch_size)
+        l_over, l_under = [to_device(torch.rand(size) * 2 - 1, device) for _ in range(2)]
+
+        def step():
+            model.zero_grad()
+            with autocast(device):
+                sr_over, sr_under, fusion = model(l_over, l_under)
+                loss = sum(o.mean() for o in sr_over + sr_under) + fusion.mean()
+            loss.backward()
+
+        for setting in SETTINGS:
+            model.recompute = recompute_blocks(setting, model.num_cfbs)
+            _, peak = peak_memory(step, device)
+            step_time = timeit(step, device, warmup=1, repeat=3)
+            print('%-8d %-10s %12.1f %12.1f' % (patch_size, setting or 'none', peak / 2 ** 20, step_time * 1e3))
+
+
+if __name__ == '__main__':
+    main()
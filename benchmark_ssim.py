@@ -0,0 +1,58 @@
+import torch
+
+from option import args
+from train import ssim_fp32, multi_ssim
+from utils import get_device, timeit
+
+# patch batches swept, (batch size, HR patch size)
+SIZES = [(4, 64), (8, 128), (16, 128)]
+
+
+def reference_loss(preds, targets, index):
+    loss = 0
+    for pred, idx in zip(preds, index):
+        loss += 1.0 - ssim_fp32(pred, targets[idx])
+    return loss
+
+
+def fused_loss(preds, targets, index):
+    return torch.sum(1.0 - multi_ssim(preds, targets, index))
+
+
+def main():
+    """
+    the multi-stage SSIM term of the training loss, one ssim call per prediction vs one fused pass,
+    forward and backward
+    """
+    device = get_device()
+    num_preds = 2 * (args.num_cfbs + 1)
+    index = [0, 1] + [2] * (num_preds - 2)
+    print('===> %d predictions against 3 targets on %s' % (num_preds, device))
+    print('%-12s %-10s %14s %14s %10s %12s' % ('batch', 'impl', 'loss', 'time (ms)', 'speedup', 'grad diff'))
+    for batch_size, size in SIZES:
+        targets = [torch.rand(batch_size, 3, size, size, device=device) * 255 for _ in range(3)]
+        preds = [(targets[idx] + 40 * torch.randn_like(targets[idx])).clamp(0, 255).requires_grad_()
+                 for idx in index]
+
+        results = {}
+        for impl, fn in (('reference', reference_loss), ('fused', fused_loss)):
+            loss = fn(preds, targets, index)
+            grads = torch.autograd.grad(loss, preds)
+
+            def step():
+                torch.autograd.grad(fn(preds, targets, index), preds)
+
+            results[impl] = (loss.item(), grads, timeit(step, device, warmup=1, repeat=5))
+
+        ref_loss, ref_grads, ref_time = results['reference']
+        loss, grads, latency = results['fused']
+        assert abs(loss - ref_loss) <= 1e-4 * num_preds, 'fused loss %g differs from %g' % (loss, ref_loss)
+        grad_diff = max((a - b).abs().max().item() for a, b in zip(grads, ref_grads))
+        name = '%dx%d^2' % (batch_size, size)
+        print('%-12s %-10s %14.6f %14.2f %10s %12s' % (name, 'reference', ref_loss, ref_time * 1e3, '', ''))
+        print('%-12s %-10s %14.6f %14.2f %9.2fx %12.2e' % (name, 'fused', loss, latency * 1e3, ref_time / latency,
+                                                            grad_diff))
+
+
+if __name__ == '__main__':
+    main()
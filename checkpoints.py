@@ -0,0 +1,117 @@
+import os
+import re
+import torch
+import random
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+from matplotlib.figure import Figure
+from pipeline import AsyncWriter
+
+EPOCH_CHECKPOINT = re.compile(r'^(\d+)\.pth$')
+
+
+def snapshot(obj):
+    """
+    copy of a (nested) state dict with every tensor detached and cloned to the CPU, safe to write while
+    training goes on updating the originals
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def atomic_save(state, path):
+    """
+    torch.save through a temporary file and a rename, a crash never leaves a truncated checkpoint
+    """
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def rng_state(generator=None):
+    """
+    every random stream training draws from, as tensors and plain Python values so that checkpoints
+    also load with torch.load(weights_only=True)
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    numpy_state = {'keys': torch.from_numpy(keys.astype(np.int64)), 'pos': int(pos), 'has_gauss': int(has_gauss),
+                   'cached_gaussian': float(cached_gaussian)}
+    state = {'python': random.getstate(), 'numpy': numpy_state, 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    if generator is not None:
+        state['generator'] = generator.get_state()
+    return state
+
+
+def set_rng_state(state, generator=None):
+    # the setters only take CPU tensors, whatever map_location the checkpoint was loaded with
+    random.setstate(state['python'])
+    numpy_state = state['numpy']
+    np.random.set_state(('MT19937', numpy_state['keys'].cpu().numpy().astype(np.uint32), numpy_state['pos'],
+                         numpy_state['has_gauss'], numpy_state['cached_gaussian']))
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+    if generator is not None and 'generator' in state:
+        generator.set_state(state['generator'].cpu())
+
+
+def plot_curve(values, path, x=None):
+    # a Figure of its own instead of pyplot's global state, plots are drawn off the training thread
+    fig = Figure()
+    ax = fig.subplots()
+    if x is None:
+        ax.plot(values)
+    else:
+        ax.plot(x, values)
+    fig.savefig(path)
+
+
+class CheckpointWriter(object):
+    """
+    writes training checkpoints and curves on a background thread
+
+    save() snapshots the state on the calling thread, so training can go on right away, and queues
+    the write. Every checkpoint goes to latest.pth, every `interval` epochs also to <epoch>.pth, of
+    which only the newest `keep_last` are kept (0 keeps all), and best checkpoints go to best_ep.pth.
+    Jobs run in order on a single thread, at most `depth` of them queued.
+    """
+
+    def __init__(self, model_path, interval=5, keep_last=0, depth=2):
+        self.model_path = model_path
+        self.interval = interval
+        self.keep_last = keep_last
+        self.writer = AsyncWriter(1, depth)
+        os.makedirs(model_path, exist_ok=True)
+        # epoch checkpoints of a run being resumed count towards keep_last
+        self.saved = sorted(int(match.group(1)) for match in map(EPOCH_CHECKPOINT.match, os.listdir(model_path))
+                            if match)
+
+    def save(self, state, epoch, best=False):
+        self.writer.submit(self._write, snapshot(state), epoch, best)
+
+    def plot(self, values, path, x=None):
+        self.writer.submit(plot_curve, list(values), path, None if x is None else list(x))
+
+    def _write(self, state, epoch, best):
+        atomic_save(state, os.path.join(self.model_path, 'latest.pth'))
+        if best:
+            atomic_save(state, os.path.join(self.model_path, 'best_ep.pth'))
+        if self.interval > 0 and epoch % self.interval == 0:
+            atomic_save(state, os.path.join(self.model_path, '%d.pth' % epoch))
+            self.saved = [ep for ep in self.saved if ep != epoch] + [epoch]
+            while self.keep_last > 0 and len(self.saved) > self.keep_last:
+                path = os.path.join(self.model_path, '%d.pth' % self.saved.pop(0))
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def close(self):
+        self.writer.close()
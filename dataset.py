@@ -1,9 +1,12 @@
 import os
 import cv2
 import random
+import torch
+import numpy as np
 import torch.utils.data as data
 
 from option import args
+from utils import to_device, rank
 
 
 class MEFdataset(data.Dataset):
@@ -21,25 +24,60 @@ class MEFdataset(data.Dataset):
         self.hr = os.listdir(self.dir_prefix + 'hr/')
         self.hr.sort()
 
+        self.num_images = len(self.hr)
+        self.rank = rank()
+
         self.scale = args.scale
         self.patch_size = args.patch_size
+        self.num_patches = args.patches_per_image
         self.transform = transform
 
     def __len__(self):
-        return len(self.hr)
+        # the whole epoch, a DistributedSampler hands every rank 1 / world_size of it
+        if args.epoch_length > 0:
+            return -(-args.epoch_length // self.num_patches)
+        return self.num_images
 
-    def __getitem__(self, idx):
+    def load(self, idx):
         lr_over = cv2.imread(self.dir_prefix + 'lr_over/' + self.lr_over[idx])
         lr_under = cv2.imread(self.dir_prefix + 'lr_under/' + self.lr_under[idx])
         hr_over = cv2.imread(self.dir_prefix + 'hr_over/' + self.hr_over[idx])
         hr_under = cv2.imread(self.dir_prefix + 'hr_under/' + self.hr_under[idx])
         hr = cv2.imread(self.dir_prefix + 'hr/' + self.hr[idx])
 
-        lr_over_p, lr_under_p, hr_over_p, hr_under_p, hr_p = self.get_patch(lr_over,
-                                                                            lr_under,
-                                                                            hr_over,
-                                                                            hr_under,
-                                                                            hr)
+        return lr_over, lr_under, hr_over, hr_under, hr
+
+    def image_index(self, idx):
+        """
+        with a fixed epoch length the item index is decoupled from the images, which are drawn
+        uniformly so that every image keeps the same share of patches whatever the epoch length
+        """
+        if args.epoch_length > 0:
+            return np.random.randint(self.num_images)
+        return idx
+
+    def seed_item(self, epoch, idx):
+        """
+        get_patch draws from `random`, get_patches and image_index from numpy. Both are seeded per item
+        from --seed, the rank, the epoch and the item, so the crops of an epoch depend neither on the
+        workers it is spread over nor on where the run was restarted
+        """
+        seed = np.random.SeedSequence([args.seed, self.rank, epoch, idx]).generate_state(1)[0]
+        random.seed(int(seed))
+        np.random.seed(seed)
+
+    def __getitem__(self, item):
+        # (epoch, idx) from an EpochSampler, a plain idx is an item of epoch 0
+        epoch, idx = item if isinstance(item, tuple) else (0, item)
+        self.seed_item(epoch, idx)
+        idx = self.image_index(idx)
+        if self.num_patches > 1:
+            patches = self.get_patches(*self.load(idx))
+            if self.transform:
+                patches = [torch.stack([self.transform(p) for p in batch]) for batch in patches]
+            return tuple(patches)
+
+        lr_over_p, lr_under_p, hr_over_p, hr_under_p, hr_p = self.get_patch(*self.load(idx))
         if self.transform:
             lr_over_p = self.transform(lr_over_p)
             lr_under_p = self.transform(lr_under_p)
@@ -67,3 +105,182 @@ class MEFdataset(data.Dataset):
         h = h[oy:oy + h_stride, ox:ox + h_stride, :]
 
         return l_over, l_under, h_over, h_under, h
+
+    def get_patches(self, l_over, l_under, h_over, h_under, h):
+        """
+        num_patches aligned random patches in one gather, each drawn like the single get_patch crop
+        """
+        lh, lw = l_over.shape[:2]
+        l_stride = self.patch_size
+        scale = self.scale
+        h_stride = l_stride * scale
+
+        x = np.random.randint(0, lw - l_stride + 1, self.num_patches)
+        y = np.random.randint(0, lh - l_stride + 1, self.num_patches)
+        l_rows = (y[:, None] + np.arange(l_stride))[:, :, None]
+        l_cols = (x[:, None] + np.arange(l_stride))[:, None, :]
+        h_rows = (scale * y[:, None] + np.arange(h_stride))[:, :, None]
+        h_cols = (scale * x[:, None] + np.arange(h_stride))[:, None, :]
+
+        l_over = l_over[l_rows, l_cols]
+        l_under = l_under[l_rows, l_cols]
+        h_over = h_over[h_rows, h_cols]
+        h_under = h_under[h_rows, h_cols]
+        h = h[h_rows, h_cols]
+
+        return l_over, l_under, h_over, h_under, h
+
+
+class EpochSampler(data.Sampler):
+    """
+    wraps the sampler of the training loader and hands out (epoch, idx), so that the workers, persistent
+    ones included, know the epoch of every item they crop, see MEFdataset.seed_item
+    """
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        return ((self.epoch, idx) for idx in self.sampler)
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+class MEFBatch(object):
+    """
+    the five uint8 HWC patch stacks of a training batch, packed back to back in one flat buffer so that
+    pinning and the host-to-device copy happen once per batch
+    """
+
+    def __init__(self, buffer, shapes):
+        self.buffer = buffer
+        self.shapes = shapes
+
+    def pin_memory(self):
+        return MEFBatch(self.buffer.pin_memory(), self.shapes)
+
+    def to(self, device):
+        """
+        float NCHW tensors on `device`: the LR pair normalized to [-1, 1] like the test transform,
+        the HR targets in [0, 255] like the network output
+        """
+        buffer = self.buffer.to(device, non_blocking=True)
+        tensors = []
+        offset = 0
+        for k, shape in enumerate(self.shapes):
+            size = int(np.prod(shape))
+            t = buffer[offset:offset + size].view(shape).permute(0, 3, 1, 2).float()
+            if k < 2:
+                t = t / 127.5 - 1
+            tensors.append(to_device(t, device))
+            offset += size
+        return tensors
+
+
+def collate_uint8(batch):
+    """
+    collate raw uint8 samples (transform=None) into a MEFBatch, the num_patches patches of every image
+    are folded into the batch dimension
+    """
+    fields = list(zip(*batch))
+    shapes = []
+    for field in fields:
+        h, w, c = field[0].shape[-3:]
+        shapes.append((sum(p.size for p in field) // (h * w * c), h, w, c))
+    buffer = torch.empty(sum(int(np.prod(shape)) for shape in shapes), dtype=torch.uint8)
+    array = buffer.numpy()
+    offset = 0
+    for field, shape in zip(fields, shapes):
+        size = int(np.prod(shape))
+        np.concatenate([p.reshape((-1,) + shape[1:]) for p in field], out=array[offset:offset + size].reshape(shape))
+        offset += size
+    return MEFBatch(buffer, shapes)
+
+
+# ------packed training store------ #
+# shard_XXX.bin hold raw uint8 HWC pixels, per sample the LR pair (2, lh, lw, 3) followed by
+# the HR triple (3, hh, hw, 3). index.npy has one row (shard, offset, lh, lw, hh, hw) per sample.
+STORE_INDEX = 'index.npy'
+STORE_SHARD = 'shard_%03d.bin'
+
+
+def pack_dataset(store_dir=args.train_store, shard_size=args.shard_size):
+    """
+    decode the dir_train quintuples once and append them to memory-mappable shards
+    """
+    if not store_dir:
+        raise ValueError('[ERROR] set --train_store to the directory the packed store is written to')
+    src = MEFdataset(transform=None)
+    os.makedirs(store_dir, exist_ok=True)
+
+    index = []
+    shard, offset = 0, 0
+    f = open(os.path.join(store_dir, STORE_SHARD % shard), 'wb')
+    for idx in range(len(src)):
+        lr_over, lr_under, hr_over, hr_under, hr = src.load(idx)
+        assert lr_over.shape == lr_under.shape and hr_over.shape == hr_under.shape == hr.shape
+        lr = np.stack([lr_over, lr_under])
+        hr = np.stack([hr_over, hr_under, hr])
+
+        if offset > 0 and offset + lr.nbytes + hr.nbytes > shard_size * 2 ** 20:
+            f.close()
+            shard, offset = shard + 1, 0
+            f = open(os.path.join(store_dir, STORE_SHARD % shard), 'wb')
+        lr.tofile(f)
+        hr.tofile(f)
+        index.append((shard, offset) + lr.shape[1:3] + hr.shape[1:3])
+        offset += lr.nbytes + hr.nbytes
+    f.close()
+
+    np.save(os.path.join(store_dir, STORE_INDEX), np.array(index, dtype=np.int64))
+    print('===> Packed %d samples into %d shards in %s' % (len(index), shard + 1, store_dir))
+
+
+class MEFmmapDataset(MEFdataset):
+    """
+    MEFdataset over a store written by pack_dataset(): patches are cropped straight out of the
+    memory-mapped shards, nothing is decoded and only the patches are copied. The read-only mappings
+    share the page cache across DataLoader workers.
+    """
+
+    def __init__(self, transform, store_dir=args.train_store):
+        super(MEFdataset, self).__init__()
+        self.store_dir = store_dir
+        self.index = np.load(os.path.join(store_dir, STORE_INDEX))
+        # opened lazily so that every DataLoader worker maps the shards itself
+        self.shards = {}
+        self.num_images = len(self.index)
+        self.rank = rank()
+
+        self.scale = args.scale
+        self.patch_size = args.patch_size
+        self.num_patches = args.patches_per_image
+        self.transform = transform
+
+    def shard(self, shard):
+        if shard not in self.shards:
+            self.shards[shard] = np.memmap(os.path.join(self.store_dir, STORE_SHARD % shard), dtype=np.uint8,
+                                           mode='r')
+        return self.shards[shard]
+
+    def load(self, idx):
+        shard, offset, lh, lw, hh, hw = [int(v) for v in self.index[idx]]
+        store = self.shard(shard)
+        lr_size = 2 * lh * lw * 3
+        hr_size = 3 * hh * hw * 3
+        lr = store[offset:offset + lr_size].reshape(2, lh, lw, 3)
+        hr = store[offset + lr_size:offset + lr_size + hr_size].reshape(3, hh, hw, 3)
+
+        return lr[0], lr[1], hr[0], hr[1], hr[2]
+
+    def get_patch(self, l_over, l_under, h_over, h_under, h):
+        patches = super(MEFmmapDataset, self).get_patch(l_over, l_under, h_over, h_under, h)
+        # the mapping is read-only, hand out writable patch copies
+        return tuple(np.ascontiguousarray(p) for p in patches)
@@ -0,0 +1,158 @@
+import os
+import cv2
+import torch
+import inspect
+import numpy as np
+import torchvision.transforms as transforms
+
+from option import args
+from model import CFNet, FusionModel
+from tiling import fuse_tiled
+from utils import get_device, memory_format, to_device, autocast, timeit
+
+INPUT_NAMES = ['lr_over', 'lr_under']
+OUTPUT_NAMES = ['fused']
+
+
+class OnnxFusion(object):
+    """
+    ONNX Runtime session with the calling convention of FusionModel
+    """
+
+    def __init__(self, path):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('[ERROR] running %s needs onnxruntime, pip install onnxruntime' % path)
+        options = onnxruntime.SessionOptions()
+        if args.num_threads > 0:
+            options.intra_op_num_threads = args.num_threads
+        if args.num_interop_threads > 0:
+            options.inter_op_num_threads = args.num_interop_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, lr_over, lr_under):
+        inputs = {name: np.ascontiguousarray(x.detach().cpu().float().numpy())
+                  for name, x in zip(INPUT_NAMES, (lr_over, lr_under))}
+        return torch.from_numpy(self.session.run(OUTPUT_NAMES, inputs)[0])
+
+
+def load_artifact(path, device):
+    """
+    callable (lr_over, lr_under) -> fused image for an exported TorchScript (.pt) or ONNX (.onnx) file
+    """
+    if path.endswith('.onnx'):
+        return OnnxFusion(path)
+    # the frozen graph as saved, optimize_for_inference made it several times slower than eager on CPU
+    return torch.jit.load(path, map_location=device).eval()
+
+
+def load_pairs(data_dir, device, num=None, indices=None):
+    """
+    the first num (lr_over, lr_under) pairs of data_dir, or those at the sorted positions in indices,
+    normalized like Test does
+    """
+    transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=[0.5, 0.5, 0.5],
+                                                                                std=[0.5, 0.5, 0.5])])
+    overs = sorted(os.listdir(data_dir + 'lr_over/'))
+    unders = sorted(os.listdir(data_dir + 'lr_under/'))
+    if indices is None:
+        indices = range(len(overs))[:num]
+    return [(transform(cv2.imread(data_dir + 'lr_over/' + overs[idx])).unsqueeze(0).to(device),
+             transform(cv2.imread(data_dir + 'lr_under/' + unders[idx])).unsqueeze(0).to(device))
+            for idx in indices]
+
+
+def load_fusion_model(device):
+    model = CFNet()
+    state = torch.load(args.model_path + args.model, map_location='cpu')
+    model.load_state_dict(state['model'])
+    return FusionModel(model).to(device, memory_format=memory_format(device)).eval()
+
+
+def load_replica(k):
+    """
+    a warm model: fuse(lr_over, lr_under) -> fused NCHW float array, on the k-th GPU if there are several
+    """
+    device = get_device()
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', k % torch.cuda.device_count())
+    if args.artifact:
+        model = load_artifact(args.artifact, device)
+    else:
+        model = load_fusion_model(device)
+
+    def run(img1, img2):
+        with autocast(device, enabled=not args.artifact):
+            return model(to_device(img1, device), to_device(img2, device)).float()
+
+    def fuse(img1, img2):
+        with torch.no_grad():
+            if args.tile_size > 0:
+                return fuse_tiled(run, img1, img2, args.scale, args.tile_size, args.tile_overlap).cpu().numpy()
+            return run(img1, img2).cpu().numpy()
+
+    # the first call sets up the backend, not the first client
+    size = args.patch_size
+    fuse(torch.zeros(1, 3, size, size), torch.zeros(1, 3, size, size))
+    return fuse
+
+
+def export_torchscript(model, example, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        traced = torch.jit.freeze(traced)
+    traced.save(path)
+
+
+def export_onnx(model, example, path):
+    axes = {'lr_over': {0: 'batch', 2: 'height', 3: 'width'},
+            'lr_under': {0: 'batch', 2: 'height', 3: 'width'},
+            'fused': {0: 'batch', 2: 'out_height', 3: 'out_width'}}
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # the tracing exporter, the dynamo one cannot follow the tap loop of FAC with symbolic sizes
+        kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(model, example, path, input_names=INPUT_NAMES, output_names=OUTPUT_NAMES,
+                          dynamic_axes=axes, opset_version=13, do_constant_folding=True, **kwargs)
+
+
+def export():
+    """
+    write frozen TorchScript and/or ONNX artifacts of args.model next to it, then check them against
+    the eager model on dir_test and time both
+    """
+    device = get_device()
+    model = load_fusion_model(device)
+    stem = os.path.splitext(args.model_path + args.model)[0]
+    # traced on a small pair, height, width and batch stay dynamic
+    example = tuple(torch.rand(1, 3, 64, 64, device=device) * 2 - 1 for _ in range(2))
+
+    paths = []
+    if args.export_format in ('torchscript', 'all'):
+        paths.append(stem + '.torchscript.pt')
+        export_torchscript(model, example, paths[-1])
+    if args.export_format in ('onnx', 'all'):
+        paths.append(stem + '.onnx')
+        export_onnx(model.cpu(), tuple(x.cpu() for x in example), paths[-1])
+        model.to(device)
+
+    pairs = load_pairs(args.dir_test, device, args.export_check)
+
+    with torch.no_grad():
+        eager_time = np.mean([timeit(lambda: model(*pair), device, warmup=1, repeat=3) for pair in pairs])
+        print('%-40s %10.1f ms' % ('eager', eager_time * 1e3))
+        for path in paths:
+            artifact = load_artifact(path, device)
+            diff = max((artifact(*pair).to(device) - model(*pair)).abs().max().item() for pair in pairs)
+            latency = np.mean([timeit(lambda: artifact(*pair), device, warmup=1, repeat=3) for pair in pairs])
+            print('%-40s %10.1f ms   %.2fx   max diff %.2e' % (os.path.basename(path), latency * 1e3,
+                                                              eager_time / latency, diff))
+            # outputs are in [0, 255] and written as uint8
+            assert diff < 0.5, '%s differs from the eager model by %g' % (path, diff)
+
+
+if __name__ == '__main__':
+    export()
@@ -1,14 +1,46 @@
+import sys
 import torch
+import random
+import numpy as np
 from test import Test
 from option import args
+from utils import get_device, init_distributed, rank
 
+# raw frames streamed to stdout, every message of any module goes to stderr instead
+if args.stream and args.stream_output == '-':
+    sys.stdout = sys.stderr
+
+# under torchrun every process joins the group, the model starts from the same weights everywhere and
+# the data streams are seeded per rank
+init_distributed()
 torch.manual_seed(args.seed)
+random.seed(args.seed + rank())
+np.random.seed(args.seed + rank())
+get_device()
 
 
 def main():
     if args.test_only:
         t = Test()
         t.test()
+    elif args.batch_fusion:
+        from batch_fusion import batch_fusion
+        batch_fusion()
+    elif args.stream:
+        from stream import Stream
+        Stream().stream()
+    elif args.serve:
+        from serve import serve
+        serve()
+    elif args.export_only:
+        from export import export
+        export()
+    elif args.quantize_only:
+        from quantize import quantize
+        quantize()
+    elif args.pack_only:
+        from dataset import pack_dataset
+        pack_dataset()
     else:
         from train import Train
         t = Train()
@@ -5,6 +5,7 @@ import torch.nn as nn
 from option import args
 from collections import OrderedDict
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 # ------helper functions------ #
 
@@ -80,6 +81,123 @@ def DeconvBlock(in_channels, out_channels, kernel_size, stride=1, dilation=1, bi
     return sequential(p, deconv, n, act)
 
 
+# ------dense projection groups shared by SRB and CFB ------ #
+def _dense_projection_cat(block, x, guide=None):
+    lr_features = []
+    hr_features = []
+    lr_features.append(x)
+
+    for idx in range(block.num_groups):
+        LD_L = torch.cat(tuple(lr_features), 1)
+        if idx > 0:
+            LD_L = block.uptranBlocks[idx - 1](LD_L)
+        LD_H = block.upBlocks[idx](LD_L)
+
+        hr_features.append(LD_H)
+
+        LD_H = torch.cat(tuple(hr_features), 1)
+        if idx > 0:
+            LD_H = block.downtranBlocks[idx - 1](LD_H)
+        LD_L = block.downBlocks[idx](LD_H)
+
+        if guide is not None and idx == 2:
+            x_mid = torch.cat((LD_L, guide), dim=1)
+            LD_L = block.re_guide(x_mid)
+
+        lr_features.append(LD_L)
+
+    del hr_features
+    return torch.cat(tuple(lr_features[1:]), 1)
+
+
+def _slab(like, channels):
+    # the memory format of like, so group outputs are written without a layout change
+    memory_format = torch.channels_last if like.dim() == 4 and not like.is_contiguous() and \
+        like.is_contiguous(memory_format=torch.channels_last) else torch.contiguous_format
+    size = (like.size(0), channels) + tuple(like.shape[2:])
+    return torch.empty(size, dtype=like.dtype, device=like.device, memory_format=memory_format)
+
+
+def _pointwise(block, x):
+    """
+    a 1x1 ConvBlock as one GEMM that reads x, a channel slice of a slab, in place
+    """
+    layers = list(block) if isinstance(block, nn.Sequential) else [block]
+    conv = layers[0]
+    N, K, H, W = x.shape
+    weight = conv.weight.view(conv.out_channels, K)
+    bias = conv.bias if conv.bias is not None else weight.new_zeros(conv.out_channels)
+    if x.stride(1) == 1:
+        # channels_last, an (N*H*W, K) matrix with the row stride of the slab
+        out = torch.addmm(bias, x.permute(0, 2, 3, 1).reshape(N * H * W, K), weight.t())
+        out = out.view(N, H, W, -1).permute(0, 3, 1, 2)
+    else:
+        # NCHW, a (K, H*W) matrix per sample
+        out = torch.baddbmm(bias.view(1, -1, 1), weight.expand(N, -1, -1), x.reshape(N, K, H * W))
+        out = out.view(N, -1, H, W)
+    for layer in layers[1:]:
+        out = layer(out)
+    return out
+
+
+def _dense_projection_slab(block, x, guide=None):
+    N, C = x.shape[:2]
+    G = block.num_groups
+    lr_slab = _slab(x, (G + 1) * C)
+    lr_slab[:, :C] = x
+    hr_slab = None
+
+    for idx in range(G):
+        LD_L = x
+        if idx > 0:
+            LD_L = _pointwise(block.uptranBlocks[idx - 1], lr_slab[:, :(idx + 1) * C])
+        LD_H = block.upBlocks[idx](LD_L)
+
+        if hr_slab is None:
+            hr_slab = _slab(LD_H, G * C)
+        hr_slab[:, idx * C:(idx + 1) * C] = LD_H
+
+        if idx > 0:
+            LD_H = _pointwise(block.downtranBlocks[idx - 1], hr_slab[:, :(idx + 1) * C])
+        LD_L = block.downBlocks[idx](LD_H)
+
+        if guide is not None and idx == 2:
+            x_mid = torch.cat((LD_L, guide), dim=1)
+            LD_L = block.re_guide(x_mid)
+
+        lr_slab[:, (idx + 1) * C:(idx + 2) * C] = LD_L
+
+    return lr_slab[:, C:]
+
+
+def _use_slab(x):
+    # in-place slab writes break autograd, traced graphs (TorchScript, FX) keep plain concatenations
+    return not (torch.is_grad_enabled() or torch.jit.is_tracing() or isinstance(x, torch.fx.Proxy))
+
+
+def dense_projection(block, x, guide=None):
+    """
+    the up/down projection groups of SRB and CFB, returns the concatenated LR group outputs
+
+    Without autograd the group outputs are written once into LR and HR slabs in the layout of x.
+    The 1x1 transition blocks read channel-prefix views of the slabs through _pointwise, a GEMM
+    with the row stride of the slab, so nothing is concatenated or copied (O(G^2) before).
+    Training and traced graphs keep the concatenating version.
+    """
+    if _use_slab(x) and x.dim() == 4:
+        return _dense_projection_slab(block, x, guide)
+    return _dense_projection_cat(block, x, guide)
+
+
+def compress(block, x):
+    """
+    compress_out of SRB and CFB, reads a slab view from dense_projection without copying it
+    """
+    if _use_slab(x) and not x.is_contiguous() and not x.is_contiguous(memory_format=torch.channels_last):
+        return _pointwise(block, x)
+    return block(x)
+
+
 # ------build SRB ------ #
 class SRB(nn.Module):
     def __init__(self, norm_type):
@@ -124,34 +242,10 @@ class SRB(nn.Module):
         self.last_hidden = None
 
     def forward(self, f_in):
-        # use cuda
-        f = torch.zeros(f_in.size()).cuda()
-        f.copy_(f_in)
+        f = self.compress_in(f_in)
 
-        f = self.compress_in(f)
-
-        lr_features = []
-        hr_features = []
-        lr_features.append(f)
-
-        for idx in range(self.num_groups):
-            LD_L = torch.cat(tuple(lr_features), 1)
-            if idx > 0:
-                LD_L = self.uptranBlocks[idx - 1](LD_L)
-            LD_H = self.upBlocks[idx](LD_L)
-
-            hr_features.append(LD_H)
-
-            LD_H = torch.cat(tuple(hr_features), 1)
-            if idx > 0:
-                LD_H = self.downtranBlocks[idx - 1](LD_H)
-            LD_L = self.downBlocks[idx](LD_H)
-
-            lr_features.append(LD_L)
-
-        del hr_features
-        g = torch.cat(tuple(lr_features[1:]), 1)
-        g = self.compress_out(g)
+        g = dense_projection(self, f)
+        g = compress(self.compress_out, g)
 
         return g
 
@@ -206,32 +300,8 @@ class CFB(nn.Module):
 
         x = self.compress_in(x)
 
-        lr_features = []
-        hr_features = []
-        lr_features.append(x)
-
-        for idx in range(self.num_groups):
-            LD_L = torch.cat(tuple(lr_features), 1)
-            if idx > 0:
-                LD_L = self.uptranBlocks[idx - 1](LD_L)
-            LD_H = self.upBlocks[idx](LD_L)
-
-            hr_features.append(LD_H)
-
-            LD_H = torch.cat(tuple(hr_features), 1)
-            if idx > 0:
-                LD_H = self.downtranBlocks[idx - 1](LD_H)
-            LD_L = self.downBlocks[idx](LD_H)
-
-            if idx == 2:
-                x_mid = torch.cat((LD_L, g2), dim=1)
-                LD_L = self.re_guide(x_mid)
-
-            lr_features.append(LD_L)
-
-        del hr_features
-        output = torch.cat(tuple(lr_features[1:]), 1)
-        output = self.compress_out(output)
+        output = dense_projection(self, x, guide=g2)
+        output = compress(self.compress_out, output)
 
         return output
 
@@ -291,9 +361,10 @@ class ResnetBlock(nn.Module):
 
         return x
 
-def FAC(feat_in, kernel, ksize):
+def FAC_unfold(feat_in, kernel, ksize):
     """
-    customized FAC
+    customized FAC, reference version: unfolds the whole padded feature map and triples the kernel
+    across channels. Kept for parity checks against FAC
     """
     channels = feat_in.size(1)
     N, kernels, H, W = kernel.size()
@@ -319,7 +390,154 @@ def FAC(feat_in, kernel, ksize):
     
     return feat_out
 
+def _fac_taps(ksize):
+    """
+    for each tap (kx, ky) the kernel channels FAC_unfold pairs with its 4 samples
+    """
+    taps = ksize * ksize
+    width = 2 * ksize
+    return [[(t % width) * width + t // width for t in range(q, 4 * taps, taps)] for q in range(taps)]
+
+
+def _fac_samples(feat_pad, ksize, q, size):
+    """
+    the 4 samples FAC_unfold pairs with tap q of every output, as (N, H, W, C, 4)
+    """
+    N, C, H, W = size
+    kx, ky = divmod(q, ksize)
+    Hf = feat_pad.size(2) - ksize + 1
+    Wf = feat_pad.size(3) - ksize + 1
+    return feat_pad[:, :, ky:ky + Hf, kx:kx + Wf].permute(0, 2, 3, 1).reshape(N, H, W, C, 4)
+
+
+def _fac_accumulate(feat_pad, kernel, ksize):
+    N, C = feat_pad.shape[:2]
+    H, W = kernel.shape[2:]
+    size = (N, C, H, W)
+
+    feat_out = feat_pad.new_zeros(N, H, W, C)
+    for q, idx in enumerate(_fac_taps(ksize)):
+        samples = _fac_samples(feat_pad, ksize, q, size)
+        weights = kernel[:, idx].permute(0, 2, 3, 1).unsqueeze(3)
+        feat_out += torch.sum(samples * weights, -1)
+
+    return feat_out.permute(0, 3, 1, 2).contiguous()
+
+
+class _FACFunction(torch.autograd.Function):
+    """
+    FAC accumulated tap by tap: every tap reads a shifted view of the padded feature map, so the
+    working set is one feature-sized buffer instead of ksize*ksize*4 of them. The backward recomputes
+    the samples instead of saving them.
+    """
+
+    @staticmethod
+    def forward(ctx, feat_pad, kernel, ksize):
+        ctx.ksize = ksize
+        ctx.save_for_backward(feat_pad, kernel)
+        return _fac_accumulate(feat_pad, kernel, ksize)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_out):
+        feat_pad, kernel = ctx.saved_tensors
+        ksize = ctx.ksize
+        N, C = feat_pad.shape[:2]
+        H, W = kernel.shape[2:]
+        size = (N, C, H, W)
+        Hf = feat_pad.size(2) - ksize + 1
+        Wf = feat_pad.size(3) - ksize + 1
+
+        grad_out = grad_out.permute(0, 2, 3, 1).unsqueeze(-1)
+        grad_feat = torch.zeros_like(feat_pad) if ctx.needs_input_grad[0] else None
+        grad_kernel = torch.zeros_like(kernel) if ctx.needs_input_grad[1] else None
+        for q, idx in enumerate(_fac_taps(ksize)):
+            kx, ky = divmod(q, ksize)
+            if grad_feat is not None:
+                weights = kernel[:, idx].permute(0, 2, 3, 1).unsqueeze(3)
+                grad_samples = (grad_out * weights).reshape(N, Hf, Wf, C).permute(0, 3, 1, 2)
+                grad_feat[:, :, ky:ky + Hf, kx:kx + Wf] += grad_samples
+            if grad_kernel is not None:
+                samples = _fac_samples(feat_pad, ksize, q, size)
+                grad_kernel[:, idx] = torch.sum(grad_out * samples, 3).permute(0, 3, 1, 2)
+
+        return grad_feat, grad_kernel, None
+
+
+def upcast(x):
+    # half precision to fp32, fp32 and fp64 stay as they are
+    if x.dtype in (torch.float16, torch.bfloat16):
+        return x.float()
+    return x
+
+
+def FAC(feat_in, kernel, ksize):
+    """
+    customized FAC, same result as FAC_unfold without materializing the unfolded feature map
+    or the tripled kernel
+    """
+    N, kernels, H, W = kernel.size()
+    if not torch.jit.is_tracing() and (kernels != ksize * ksize * 4 or feat_in.size(2) * feat_in.size(3) != 4 * H * W):
+        raise NotImplementedError('[ERROR] FAC expects %d kernel channels at half the feature resolution, got %s'
+                                  % (ksize * ksize * 4, tuple(kernel.size())))
+    pad = (ksize - 1) // 2
+
+    # the 196-term accumulation stays in fp32 under autocast
+    feat_in = F.pad(upcast(feat_in), (pad, pad, pad, pad), mode="replicate")
+    kernel = upcast(kernel)
+    if torch.jit.is_tracing() or not (torch.is_grad_enabled() and (feat_in.requires_grad or kernel.requires_grad)):
+        # plain ops can be traced and exported, the autograd Function cannot
+        return _fac_accumulate(feat_in, kernel, ksize)
+    return _FACFunction.apply(feat_in, kernel, ksize)
+
+
+# ------output mapping------ #
+
+def output_image(res, up):
+    """
+    reconstruction residual plus the upsampled input, mapped to [0, 255] in fp32 under autocast
+    """
+    image = torch.add(upcast(res), upcast(up))
+    image = torch.clamp(image, -1.0, 1.0)
+    return (image + 1) * 127.5
+
+
+def fusion_image(drb):
+    """
+    the DRB output mapped to [0, 255] in fp32 under autocast, clamped like output_image
+    """
+    fusion = torch.clamp(upcast(drb), -1.0, 1.0)
+    return (fusion + 1) * 127.5
+
+
+# FAC and the output mapping are leaves of FX graphs, so they stay in float in the quantized model
+torch.fx.wrap('FAC')
+torch.fx.wrap('output_image')
+torch.fx.wrap('fusion_image')
+
+
+def recompute_blocks(spec, num_cfbs):
+    """
+    parse a --recompute spec: comma-separated srb, cfb, drb, all or single stages such as cfb1, drb2
+    """
+    groups = {'srb': ['srb'],
+              'cfb': ['cfb%d' % i for i in range(num_cfbs)],
+              'drb': ['drb%d' % i for i in range(3)]}
+    groups['all'] = groups['srb'] + groups['cfb'] + groups['drb']
+    blocks = set()
+    for name in filter(None, [n.strip().lower() for n in spec.split(',')]):
+        if name not in groups and name not in groups['all']:
+            raise NotImplementedError('[ERROR] Recompute block [%s] does not exist!' % name)
+        blocks.update(groups.get(name, [name]))
+    return blocks
+
+
 # ------build CFNet ------ #
+# what CFNet.forward can be asked for, see its docstring
+OUTPUTS = ('all', 'sr', 'fusion')
+# the three DRB stages read the SRB features and those of the first two CFBs
+DRB_CFBS = 2
+
 class CFNet(nn.Module):
     def __init__(self, in_channels=args.in_channels, out_channels=args.out_channels, num_features=args.num_features,
                  num_steps=args.num_steps, upscale_factor=args.scale,
@@ -391,8 +609,8 @@ class CFNet(nn.Module):
         for i in range(self.num_cfbs):
             cfb_over = 'cfb_over{}'.format(i)
             cfb_under = 'cfb_under{}'.format(i)
-            cfb_1 = CFB(norm_type).cuda()
-            cfb_2 = CFB(norm_type).cuda()
+            cfb_1 = CFB(norm_type)
+            cfb_2 = CFB(norm_type)
             setattr(self, cfb_over, cfb_1)
             self.CFBs_1.append(getattr(self, cfb_over))
             setattr(self, cfb_under, cfb_2)
@@ -432,12 +650,39 @@ class CFNet(nn.Module):
             Conv(num_features, num_features, kernel_size=ks, stride=1),
             conv(num_features, 3, kernel_size=1, stride=1) 
         )
+
+        # blocks whose activations are recomputed in the backward
+        self.recompute = recompute_blocks(args.recompute, num_cfbs)
         
+    def _run(self, block, fn, *inputs):
+        """
+        fn(*inputs), recomputed in the backward instead of keeping its activations if `block` is
+        selected by --recompute
+        """
+        if block in self.recompute and self.training and torch.is_grad_enabled():
+            return checkpoint(fn, *inputs, use_reentrant=False)
+        return fn(*inputs)
+
+    def drb_stage(self, img, g_a, g_b):
+        img_feature = self.feature0(img)
+        img_cat = torch.cat([img_feature, g_a, g_b], 1)
+        kernel = self.kernel(img_cat)
+        res = self.res(img_cat)
+        fac = FAC(img, kernel, self.kernel_width)
+        fac = F.interpolate(fac, scale_factor=2, mode='area')
+        res = F.interpolate(res, scale_factor=2, mode='area')
+        return img + fac + res
+
     # def forward(self, lr_over, lr_under):
-    def forward(self, lr_over, lr_under):
-        # upsampled version of input pairs
-        up_over = self.upsample_over(lr_over)
-        up_under = self.upsample_under(lr_under)
+    def forward(self, lr_over, lr_under, outputs='all'):
+        """
+        outputs selects what is computed and returned:
+            'all'       sr_over, sr_under (lists over the num_cfbs + 1 stages) and fusion, for training
+            'sr'        the final sr_over and sr_under images, the DRB and earlier heads are skipped
+            'fusion'    the DRB fusion only, no reconstruction head and no CFB after the ones it reads
+        """
+        if outputs not in OUTPUTS:
+            raise ValueError('[ERROR] outputs must be one of %s, got %s' % (', '.join(OUTPUTS), outputs))
 
         # Feature extraction block
         f_in_over = self.conv_in_over(lr_over)
@@ -447,51 +692,44 @@ class CFNet(nn.Module):
         f_in_under = self.feat_in_under(f_in_under)
 
         # Super-resolution block
-        g_over = self.srb_1(f_in_over)
-        g_under = self.srb_2(f_in_under)
+        g_over = self._run('srb', self.srb_1, f_in_over)
+        g_under = self._run('srb', self.srb_2, f_in_under)
 
-        # Coupled feedback block
+        # Coupled feedback block, the DRB reads the features of the first DRB_CFBS only
+        num_cfbs = min(self.num_cfbs, DRB_CFBS) if outputs == 'fusion' else self.num_cfbs
         g_1 = [g_over]
         g_2 = [g_under]
-        for i in range(self.num_cfbs):
-            g_1.append(self.CFBs_1[i](f_in_over, g_1[i], g_2[i]))
-            g_2.append(self.CFBs_2[i](f_in_under, g_2[i], g_1[i]))
-
-        #DRB 残差模块
-        drb = []
-        img_average = (lr_over +lr_under) / 2.0
-        img_average = self.img_upsample(img_average)
-        img_feature_1 = self.feature0(img_average)
-        img_cat1 = torch.cat([g_2[0],g_1[0]],1)
-        img_cat_1 = torch.cat([img_feature_1,img_cat1],1)
-        kernel1 = self.kernel(img_cat_1)
-        res1 = self.res(img_cat_1)
-        fac1 = FAC(img_average,kernel1,self.kernel_width)
-        fac1 = F.interpolate(fac1, scale_factor=2, mode='area')
-        res1 = F.interpolate(res1, scale_factor=2, mode='area')
-        drb.append(img_average + fac1 +res1)
-        
-        img_feature_2 = self.feature0(drb[0])
-        img_cat2 = torch.cat([g_2[1],g_1[1]],1)
-        img_cat_2 = torch.cat([img_feature_2,img_cat2],1)
-        kernel2 = self.kernel(img_cat_2)
-        res2 = self.res(img_cat_2)
-        fac2 = FAC(drb[0],kernel2,self.kernel_width)
-        fac2 = F.interpolate(fac2, scale_factor=2, mode='area')
-        res2 = F.interpolate(res2, scale_factor=2, mode='area')
-        drb.append(drb[0] + fac2 + res2)
-        
-        img_feature_3 = self.feature0(drb[1])
-        img_cat3 = torch.cat([g_1[2],g_2[2]],1)
-        img_cat_3 = torch.cat([img_feature_3,img_cat3],1)
-        kernel3 = self.kernel(img_cat_3)
-        res3 = self.res(img_cat_3)
-        fac3 = FAC(drb[1],kernel3,self.kernel_width)
-        fac3 = F.interpolate(fac3, scale_factor=2, mode='area')
-        res3 = F.interpolate(res3, scale_factor=2, mode='area')
-        drb.append(drb[1] + fac3 + res3)
-        
-        
+        for i in range(num_cfbs):
+            g_1.append(self._run('cfb%d' % i, self.CFBs_1[i], f_in_over, g_1[i], g_2[i]))
+            g_2.append(self._run('cfb%d' % i, self.CFBs_2[i], f_in_under, g_2[i], g_1[i]))
+
+        if outputs != 'sr':
+            #DRB 残差模块
+            drb = []
+            img_average = (lr_over +lr_under) / 2.0
+            img_average = self.img_upsample(img_average)
+            drb.append(self._run('drb0', self.drb_stage, img_average, g_2[0], g_1[0]))
+            drb.append(self._run('drb1', self.drb_stage, drb[0], g_2[1], g_1[1]))
+            drb.append(self._run('drb2', self.drb_stage, drb[1], g_1[2], g_2[2]))
+
+            fusion = fusion_image(drb[2])
+            if outputs == 'fusion':
+                return fusion
+
+        # upsampled version of input pairs
+        up_over = self.upsample_over(lr_over)
+        up_under = self.upsample_under(lr_under)
+
+        if outputs == 'sr':
+            # Reconstruction of the last stage only
+            if self.num_cfbs == 0:
+                res_over = self.conv_out_over(self.out_over(g_over))
+                res_under = self.conv_out_under(self.out_under(g_under))
+            else:
+                res_over = self.conv_out_1[-1](self.out_1[-1](g_1[-1]))
+                res_under = self.conv_out_2[-1](self.out_2[-1](g_2[-1]))
+            return output_image(res_over, up_over), output_image(res_under, up_under)
+
         # Reconstruction
         res_1 = []
         res_2 = []
@@ -511,17 +749,26 @@ class CFNet(nn.Module):
         sr_over = []
         sr_under = []
         for k in range(self.num_cfbs + 1):
-            image_over = torch.add(res_1[k], up_over)
-            image_over = torch.clamp(image_over, -1.0, 1.0)
-            image_over = (image_over + 1) * 127.5
-            image_under = torch.add(res_2[k], up_under)
-            image_under = torch.clamp(image_under, -1.0, 1.0)
-            image_under = (image_under + 1) * 127.5
-            sr_over.append(image_over)
-            sr_under.append(image_under)
-
-        fusion = drb[2] 
-        fusion = torch.clamp(fusion,-1.0,1.0)
-        fusion = (drb[2]+1)*127.5
+            sr_over.append(output_image(res_1[k], up_over))
+            sr_under.append(output_image(res_2[k], up_under))
 
         return sr_over,sr_under,fusion
+
+class FusionModel(nn.Module):
+    """
+    CFNet reduced to the fused image Test writes, also the graph that gets exported. 'sr' averages
+    the final SR pair, 'fusion' is the DRB output
+    """
+
+    def __init__(self, model, output=args.test_output):
+        super(FusionModel, self).__init__()
+        if output not in ('sr', 'fusion'):
+            raise ValueError('[ERROR] the fused image is built from sr or fusion, got %s' % output)
+        self.model = model
+        self.output = output
+
+    def forward(self, lr_over, lr_under):
+        if self.output == 'fusion':
+            return self.model(lr_over, lr_under, outputs='fusion')
+        sr_over, sr_under = self.model(lr_over, lr_under, outputs='sr')
+        return 0.5 * sr_over + 0.5 * sr_under
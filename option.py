@@ -14,8 +14,18 @@ parser.add_argument('--test_only', action='store_true',
 # Data specifications
 parser.add_argument('--dir_train', type=str, default='dataset/train_data/',
                     help='training dataset directory')
+parser.add_argument('--train_store', type=str, default='',
+                    help='packed training store to read instead of dir_train, see --pack_only')
+parser.add_argument('--shard_size', type=int, default=1024,
+                    help='maximum size in MB of one packed training shard')
+parser.add_argument('--pack_only', action='store_true',
+                    help='pack dir_train into --train_store and exit')
 parser.add_argument('--dir_val', type=str, default='dataset/val_data/',
                     help='validation dataset directory')
+parser.add_argument('--val_interval', type=int, default=1,
+                    help='validate every val_interval epochs, 0 disables validation')
+parser.add_argument('--val_batch_size', type=int, default=4,
+                    help='validation pairs of the same size evaluated together')
 parser.add_argument('--dir_test', type=str, default='dataset/test_data/',
                     help='test dataset directory')
 parser.add_argument('--model_path', type=str, default='model/',
@@ -28,10 +38,81 @@ parser.add_argument('--scale', type=int, default=4,
                     help='super resolution scale')
 parser.add_argument('--batch_size', type=int, default=4,
                     help='number of batches each time')
+parser.add_argument('--num_workers', type=int, default=4,
+                    help='training data loader processes, 0 loads in the training process')
+parser.add_argument('--prefetch_factor', type=int, default=2,
+                    help='batches loaded ahead by every data loader worker')
 parser.add_argument('--patch_size', type=int, default=64,
                     help='input patch size')
+parser.add_argument('--patches_per_image', type=int, default=1,
+                    help='random aligned patches cropped from every decoded training image')
+parser.add_argument('--epoch_length', type=int, default=0,
+                    help='training patches per epoch, 0 decodes every training image once per epoch')
 parser.add_argument('--save_dir', type=str, default='test_results',
                     help='test results directory')
+parser.add_argument('--save_interval', type=int, default=5,
+                    help='also keep the checkpoint of every save_interval epochs as <epoch>.pth, 0 disables')
+parser.add_argument('--keep_last', type=int, default=0,
+                    help='number of <epoch>.pth checkpoints kept, 0 keeps all')
+parser.add_argument('--test_batch_size', type=int, default=1,
+                    help='number of same-sized pairs fused per forward at test time')
+parser.add_argument('--decode_threads', type=int, default=2,
+                    help='threads decoding test pairs ahead of the model, 0 decodes inline')
+parser.add_argument('--prefetch_depth', type=int, default=8,
+                    help='maximum number of decoded pairs waiting for the model')
+parser.add_argument('--encode_threads', type=int, default=2,
+                    help='threads encoding and writing fused images, 0 writes inline')
+parser.add_argument('--write_depth', type=int, default=8,
+                    help='maximum number of fused images waiting to be written')
+parser.add_argument('--test_output', type=str, default='sr', choices=['sr', 'fusion'],
+                    help='fused image written by test, sr averages the final SR pair, fusion is the DRB output')
+parser.add_argument('--artifact', type=str, default='',
+                    help='exported .pt (TorchScript) or .onnx model to test with instead of the eager CFNet')
+parser.add_argument('--tile_size', type=int, default=0,
+                    help='LR tile size for tiled inference, 0 runs whole images')
+parser.add_argument('--tile_overlap', type=int, default=16,
+                    help='overlap between neighbouring LR tiles, blended linearly')
+parser.add_argument('--tile_memory', type=int, default=0,
+                    help='peak activation memory budget in MB, picks the tile size when --tile_size is 0')
+parser.add_argument('--batch_fusion', action='store_true',
+                    help='fuse dir_test with a pool of processes and exit, see batch_fusion.py')
+parser.add_argument('--fusion_workers', type=int, default=0,
+                    help='processes of --batch_fusion, 0 fills the cores with --worker_threads each')
+parser.add_argument('--worker_threads', type=int, default=2,
+                    help='threads of every --batch_fusion process, which decodes and writes inline')
+parser.add_argument('--fusion_report', type=str, default='',
+                    help='JSON file the merged --batch_fusion timings are written to')
+parser.add_argument('--stream', action='store_true',
+                    help='fuse a video or image sequence of exposure pairs into a video or raw stream, see stream.py')
+parser.add_argument('--stream_input', type=str, default='',
+                    help='video or image sequence pattern (frames/%%04d.png) of alternating exposures, or a '
+                         'directory with lr_over/ and lr_under/')
+parser.add_argument('--stream_output', type=str, default='fused.mp4',
+                    help='video file of the fused frames, a .raw file or - (stdout) for raw bgr24 frames')
+parser.add_argument('--stream_first', type=str, default='over', choices=['over', 'under'],
+                    help='exposure of the first frame of an alternating input')
+parser.add_argument('--stream_batch', type=int, default=4,
+                    help='consecutive frame pairs fused together')
+parser.add_argument('--stream_fourcc', type=str, default='mp4v',
+                    help='codec of the output video')
+parser.add_argument('--stream_fps', type=float, default=0,
+                    help='frame rate of the output video, 0 is half that of an alternating input, else 30')
+
+# Service specifications
+parser.add_argument('--serve', action='store_true',
+                    help='run the fusion service until interrupted, see serve.py')
+parser.add_argument('--host', type=str, default='127.0.0.1',
+                    help='address the fusion service listens on')
+parser.add_argument('--port', type=int, default=8000,
+                    help='port the fusion service listens on, 0 picks a free one')
+parser.add_argument('--socket', type=str, default='',
+                    help='Unix socket the fusion service listens on instead of --host and --port')
+parser.add_argument('--serve_replicas', type=int, default=1,
+                    help='model instances of the fusion service, each fusing batches on its own thread')
+parser.add_argument('--max_batch', type=int, default=8,
+                    help='largest dynamic batch of same-size pairs')
+parser.add_argument('--max_latency', type=float, default=10,
+                    help='milliseconds a queued pair waits for others of its size to fill a batch')
 
 # Model specifications
 parser.add_argument('--in_channels', type=int, default=3,
@@ -47,6 +128,82 @@ parser.add_argument('--num_cfbs', type=int, default=3,
 parser.add_argument('--num_steps', type=int, default=2)
 parser.add_argument('--act_type', type=str, default='prelu',
                     help='type of activation function')
+parser.add_argument('--recompute', type=str, default='',
+                    help='blocks recomputed in the backward to save activation memory: comma-separated '
+                         'srb, cfb, drb, all or single stages such as cfb1, drb0')
+
+# Loss specifications
+parser.add_argument('--vgg_weights', type=str, default='',
+                    help='local vgg19 weights for the perceptual loss (truncated features or full state dict), '
+                         'empty downloads them')
+parser.add_argument('--vgg_layer', type=int, default=20,
+                    help='perceptual loss on vgg19 features[:vgg_layer]')
+parser.add_argument('--vgg_normalize', type=str, default='none', choices=['none', 'imagenet'],
+                    help='VGG input normalization, none feeds [0, 255] BGR as before')
+parser.add_argument('--vgg_batching', type=str, default='split', choices=['concat', 'split'],
+                    help='concat runs prediction and target in one VGG pass, split runs the target without autograd')
+
+# Hardware specifications
+parser.add_argument('--device', type=str, default='auto',
+                    help='device to run on: auto | cpu | cuda | cuda:N')
+parser.add_argument('--num_threads', type=int, default=0,
+                    help='intra-op threads on CPU, 0 keeps the torch default')
+parser.add_argument('--num_interop_threads', type=int, default=0,
+                    help='inter-op threads on CPU, 0 keeps the torch default')
+parser.add_argument('--dist_backend', type=str, default='gloo', choices=['gloo', 'nccl'],
+                    help='torch.distributed backend of multi-process training started with torchrun')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                    help='autocast precision for training and inference, fp16 falls back to bf16 on CPU')
+
+# Profiling specifications
+parser.add_argument('--profile', action='store_true',
+                    help='record time, FLOPs and output sizes of the CFNet blocks and FAC while testing or training')
+parser.add_argument('--profile_depth', type=int, default=1,
+                    help='module levels below CFNet profiled, 1 for the blocks, 2 also for their layers')
+parser.add_argument('--profile_steps', type=int, default=10,
+                    help='training steps profiled with --profile, from the first one')
+parser.add_argument('--profile_trace', type=str, default='cfnet_trace.json',
+                    help='Chrome trace written by --profile')
+
+# Export specifications
+parser.add_argument('--export_only', action='store_true',
+                    help='export args.model as an optimized inference artifact and exit')
+parser.add_argument('--export_format', type=str, default='all', choices=['torchscript', 'onnx', 'all'],
+                    help='artifact formats written by --export_only')
+parser.add_argument('--export_check', type=int, default=4,
+                    help='test pairs used to check and time the exported artifacts')
+
+# Quantization specifications
+parser.add_argument('--quantize_only', action='store_true',
+                    help='write an int8 artifact of args.model for CPU inference and exit')
+parser.add_argument('--quant_data', type=str, default='val', choices=['val', 'train'],
+                    help='calibration pairs, dir_val or a random sample of dir_train')
+parser.add_argument('--quant_calib', type=int, default=16,
+                    help='number of calibration pairs')
+
+# Benchmark specifications
+parser.add_argument('--bench_sizes', type=str, default='64,128',
+                    help='comma-separated LR sizes swept by benchmark_components.py')
+parser.add_argument('--bench_scales', type=str, default='',
+                    help='comma-separated scales swept, empty uses --scale')
+parser.add_argument('--bench_groups', type=str, default='',
+                    help='comma-separated num_groups swept, empty uses --num_groups')
+parser.add_argument('--bench_cfbs', type=str, default='',
+                    help='comma-separated num_cfbs swept, empty uses --num_cfbs')
+parser.add_argument('--bench_threads', type=str, default='',
+                    help='comma-separated CPU thread counts swept, empty uses the current one')
+parser.add_argument('--bench_procs', type=str, default='1,2,4,8',
+                    help='comma-separated process counts of benchmark_ddp.py')
+parser.add_argument('--bench_repeat', type=int, default=5,
+                    help='timed runs per measurement, the median is reported')
+parser.add_argument('--bench_json', type=str, default='benchmark_components.json',
+                    help='file the benchmark results are written to')
+parser.add_argument('--bench_ddp_json', type=str, default='benchmark_ddp.json',
+                    help='file the benchmark_ddp.py results are written to')
+parser.add_argument('--bench_baseline', type=str, default='',
+                    help='earlier --bench_json results to compare against')
+parser.add_argument('--bench_tolerance', type=float, default=0.1,
+                    help='relative slowdown against the baseline reported as a regression')
 
 parser.add_argument('--eval', action='store_true',
                     help='evaluate the test results')
@@ -1,20 +1,73 @@
 import torch
 import torch.nn as nn
+from option import args
 from torchvision.models import vgg19
 
+# ImageNet statistics of the RGB channels the VGG weights were trained on
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+def load_vgg_features(path, cut):
+    """
+    vgg19().features[:cut] with the weights in path, either a saved truncated features state dict or a
+    full torchvision vgg19 state dict, layers past the cut are dropped
+    """
+    vgg = vgg19().features[:cut]
+    state = torch.load(path, map_location='cpu')
+    state = {key[len('features.'):] if key.startswith('features.') else key: value for key, value in state.items()
+             if not key.startswith('classifier.')}
+    state = {key: value for key, value in state.items() if int(key.split('.')[0]) < cut}
+    vgg.load_state_dict(state)
+    return vgg
+
+
 class PerceptualLoss(nn.Module):
-    def __init__(self):
+    def __init__(self, weights=args.vgg_weights, cut=args.vgg_layer, normalize=args.vgg_normalize,
+                 batching=args.vgg_batching):
         super(PerceptualLoss, self).__init__()
 
-        self.vgg = vgg19(pretrained=True).features[:20].eval() 
+        if weights:
+            self.vgg = load_vgg_features(weights, cut).eval()
+        else:
+            self.vgg = vgg19(pretrained=True).features[:cut].eval()
         for param in self.vgg.parameters():
-            param.requires_grad = False  
-        self.vgg = self.vgg.cuda()
+            param.requires_grad = False
+
+        if normalize not in ('none', 'imagenet'):
+            raise NotImplementedError('[ERROR] VGG input normalization [%s] is not implemented!' % normalize)
+        if batching not in ('concat', 'split'):
+            raise NotImplementedError('[ERROR] VGG batching [%s] is not implemented!' % batching)
+        self.normalize = normalize
+        self.batching = batching
+        self.register_buffer('mean', torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1) * 255)
+        self.register_buffer('std', torch.tensor(IMAGENET_STD).view(1, 3, 1, 1) * 255)
+
+    def prepare(self, img):
+        # images are cv2 BGR in [0, 255], ImageNet statistics are for RGB in [0, 1]
+        if self.normalize == 'imagenet':
+            return (img.flip(1) - self.mean) / self.std
+        return img
+
     def forward(self, predicted, real):
-        
-        predicted_features = self.vgg(predicted.cuda())
-        real_features = self.vgg(real.cuda())
-        
-        loss = torch.mean((predicted_features - real_features) ** 2)
-        
-        return loss
\ No newline at end of file
+        if self.batching == 'concat':
+            # one pass over prediction and target, only the prediction half receives gradients
+            features = self.vgg(self.prepare(torch.cat([predicted, real.to(predicted.dtype)])))
+            predicted_features, real_features = features.chunk(2)
+            real_features = real_features.detach()
+        else:
+            predicted_features = self.vgg(self.prepare(predicted))
+            with torch.no_grad():
+                real_features = self.vgg(self.prepare(real))
+
+        loss = torch.mean((predicted_features.float() - real_features.float()) ** 2)
+
+        return loss
+
+
+if __name__ == '__main__':
+    # on a machine with internet access: write the truncated weights to copy to offline nodes
+    if not args.vgg_weights:
+        raise ValueError('[ERROR] set --vgg_weights to the file to write')
+    torch.save(vgg19(pretrained=True).features[:args.vgg_layer].state_dict(), args.vgg_weights)
+    print('===> Saved vgg19 features[:%d] to %s' % (args.vgg_layer, args.vgg_weights))
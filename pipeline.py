@@ -0,0 +1,118 @@
+import threading
+from queue import Queue, Full
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch(load, items, num_threads, depth):
+    """
+    yield load(item) for every item in order, computed ahead by a thread pool
+
+    At most `depth` results are in flight: a new item is only submitted once the consumer has taken
+    one, so a slow consumer throttles the loaders instead of filling memory.
+    With num_threads=0 everything runs in the calling thread.
+    """
+    if num_threads <= 0:
+        for item in items:
+            yield load(item)
+        return
+
+    with ThreadPoolExecutor(num_threads, thread_name_prefix='prefetch') as pool:
+        pending = deque()
+        for item in items:
+            if len(pending) >= max(depth, 1):
+                yield pending.popleft().result()
+            pending.append(pool.submit(load, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+def background(items, depth):
+    """
+    yield the items of an iterable that is consumed on a background thread, at most `depth` ahead
+
+    For sources that have to be read in order, e.g. the frames of a video, where prefetch() cannot
+    load items in parallel. An exception of the producer is re-raised in the caller, and a caller
+    that stops early stops the producer.
+    """
+    queue = Queue(max(depth, 1))
+    stop = threading.Event()
+
+    def put(entry):
+        # time out now and then to notice a caller that has gone away
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((True, item)):
+                    return
+        except Exception as e:
+            put((False, e))
+            return
+        put((False, None))
+
+    thread = threading.Thread(target=produce, name='producer', daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, item = queue.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class AsyncWriter(object):
+    """
+    background pool for output jobs (encoding, writing) with a bounded backlog
+
+    submit() blocks while `depth` jobs are queued or running. The first exception raised by a job is
+    re-raised by the next submit() or by close().
+    """
+
+    def __init__(self, num_threads, depth):
+        self.pool = ThreadPoolExecutor(num_threads, thread_name_prefix='writer') if num_threads > 0 else None
+        self.slots = threading.BoundedSemaphore(max(depth, 1))
+        self.error = None
+
+    def _done(self, future):
+        if future.exception() is not None and self.error is None:
+            self.error = future.exception()
+        self.slots.release()
+
+    def submit(self, fn, *args):
+        if self.error is not None:
+            raise self.error
+        if self.pool is None:
+            fn(*args)
+            return
+        self.slots.acquire()
+        self.pool.submit(fn, *args).add_done_callback(self._done)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.pool is not None:
+            self.pool.shutdown(wait=True)
+        return False
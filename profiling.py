@@ -0,0 +1,284 @@
+import json
+import time
+import torch
+import torch.nn as nn
+import model as cfnet
+
+from collections import OrderedDict
+from utils import synchronize
+
+
+def tensors(obj):
+    if torch.is_tensor(obj):
+        return [obj]
+    if isinstance(obj, (list, tuple)):
+        return [t for item in obj for t in tensors(item)]
+    return []
+
+
+def conv_flops(module, inputs, output):
+    """
+    multiply-adds * 2 of a Conv2d / ConvTranspose2d call
+    """
+    kernel = module.weight[0].numel()
+    if isinstance(module, nn.ConvTranspose2d):
+        # every input element is scattered through out_channels / groups kernels
+        return 2 * inputs[0].numel() * kernel
+    return 2 * output.numel() * kernel
+
+
+def fac_flops(inputs, output):
+    # every output element takes ksize^2 taps of each of its 4 quarter-resolution samples, one multiply-add each
+    ksize = inputs[2]
+    return 2 * 4 * ksize * ksize * output.numel()
+
+
+class _Mark(torch.autograd.Function):
+    """
+    identity on its tensors that calls callback() when their gradients have been computed
+    """
+
+    @staticmethod
+    def forward(ctx, callback, *inputs):
+        ctx.callback = callback
+        return tuple(t.view_as(t) for t in inputs)
+
+    @staticmethod
+    def backward(ctx, *grads):
+        ctx.callback()
+        return (None,) + grads
+
+
+class ModuleProfiler(object):
+    """
+    records every call of the named submodules of a CFNet, of FAC and of the DRB stages: wall time of
+    the forward and of the backward, FLOPs, output shapes and bytes, and the growth of allocated memory
+    over the forward
+
+        with ModuleProfiler(model) as prof:
+            model(lr_over, lr_under)
+        prof.report('trace.json')
+
+    Hooks are attached on entry and removed on exit, and FAC / drb_stage are swapped for timed
+    wrappers for that time only, a model outside the context runs exactly as before. depth selects
+    the modules by name: 1 profiles the blocks of CFNet (srb_1, cfb_over0, out_1.0, kernel, ...),
+    2 also their layers and so on. FLOPs are counted on the Conv2d / ConvTranspose2d layers and
+    added to every profiled module they run in. The CPU allocator keeps no statistics, there the
+    allocations are taken from a torch.profiler memory trace, which costs a little time per op.
+    """
+
+    def __init__(self, model, depth=1, backward=True):
+        self.model = model
+        self.depth = depth
+        self.backward = backward
+        self.device = next(model.parameters()).device
+        self.events = []
+        self.handles = []
+        self.active = []
+        self.originals = {}
+        self.origin = None
+        # CPU memory: torch.profiler session and the open record_function range of every active event
+        self.memory_profiler = None
+        self.ranges = {}
+
+    # ---- recording ----
+
+    def now(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def begin(self, name):
+        synchronize(self.device)
+        event = {'name': name, 'phase': 'forward', 'ts': self.now(), 'flops': 0}
+        if self.device.type == 'cuda':
+            event['allocated'] = torch.cuda.memory_allocated(self.device)
+        elif self.memory_profiler is not None:
+            event['range'] = 'ModuleProfiler/%d' % len(self.ranges)
+            self.ranges[event['range']] = torch.autograd.profiler.record_function(event['range'])
+            self.ranges[event['range']].__enter__()
+        self.active.append(event)
+        return event
+
+    def end(self, event, output):
+        synchronize(self.device)
+        event['dur'] = self.now() - event['ts']
+        outputs = tensors(output)
+        event['shapes'] = [list(t.shape) for t in outputs]
+        event['bytes'] = sum(t.numel() * t.element_size() for t in outputs)
+        if self.device.type == 'cuda':
+            event['allocated'] = torch.cuda.memory_allocated(self.device) - event['allocated']
+        elif 'range' in event:
+            self.ranges[event['range']].__exit__(None, None, None)
+        self.active.remove(event)
+        self.events.append(event)
+
+    def add_flops(self, flops):
+        for event in self.active:
+            event['flops'] += flops
+
+    def backward_event(self, name, inputs):
+        """
+        time the backward of a call, which ends once the gradients of its inputs are computed: the
+        inputs that need one are passed through an identity node that takes that time. Returns the
+        event and the inputs to call with. Calls on inputs without gradient, e.g. the images, have no
+        such end and are not recorded in the backward
+        """
+        grad_inputs = [t for t in inputs if torch.is_tensor(t) and t.requires_grad]
+        if not self.backward or not torch.is_grad_enabled() or not grad_inputs:
+            return None, inputs
+        event = {'name': name, 'phase': 'backward', 'flops': 0}
+
+        def grad_done():
+            if 'ts' in event:
+                synchronize(self.device)
+                event['dur'] = self.now() - event['ts']
+                self.events.append(event)
+
+        marked = iter(_Mark.apply(grad_done, *grad_inputs))
+        return event, tuple(next(marked) if torch.is_tensor(t) and t.requires_grad else t for t in inputs)
+
+    def mark_output(self, event, output):
+        # the backward of the call starts when the gradient of its output arrives
+        if event is None or not torch.is_tensor(output) or not output.requires_grad:
+            return output
+
+        def grad_ready():
+            synchronize(self.device)
+            event['ts'] = self.now()
+
+        return _Mark.apply(grad_ready, output)[0]
+
+    # ---- hooks ----
+
+    def module_hooks(self, name):
+        pending = []
+
+        def pre_hook(module, inputs):
+            backward, inputs = self.backward_event(name, inputs)
+            pending.append((self.begin(name), backward))
+            return inputs
+
+        def hook(module, inputs, output):
+            event, backward = pending.pop()
+            self.end(event, output)
+            return self.mark_output(backward, output)
+
+        return pre_hook, hook
+
+    def timed(self, name, fn, flops=None):
+        def wrapper(*args):
+            backward, args = self.backward_event(name, args)
+            event = self.begin(name)
+            output = fn(*args)
+            if flops is not None:
+                self.add_flops(flops(args, output))
+            self.end(event, output)
+            return self.mark_output(backward, output)
+        return wrapper
+
+    def profiled_modules(self, module=None, prefix='', level=0):
+        """
+        (name, module) of the modules at most `depth` levels below CFNet, items of a ModuleList count
+        as the level of the list
+        """
+        module = self.model if module is None else module
+        for name, child in module.named_children():
+            if isinstance(child, nn.ModuleList):
+                for item in self.profiled_modules(child, prefix + name + '.', level):
+                    yield item
+                continue
+            yield prefix + name, child
+            if level + 1 < self.depth:
+                for item in self.profiled_modules(child, prefix + name + '.', level + 1):
+                    yield item
+
+    def start(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        if self.device.type == 'cpu':
+            self.ranges = {}
+            self.memory_profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                                          profile_memory=True)
+            self.memory_profiler.__enter__()
+        for name, module in self.profiled_modules():
+            pre_hook, hook = self.module_hooks(name)
+            self.handles.append(module.register_forward_pre_hook(pre_hook))
+            self.handles.append(module.register_forward_hook(hook))
+        for module in self.model.modules():
+            if isinstance(module, (nn.Conv2d, nn.ConvTranspose2d)):
+                self.handles.append(module.register_forward_hook(
+                    lambda module, inputs, output: self.add_flops(conv_flops(module, inputs, output))))
+        self.originals['FAC'] = cfnet.FAC
+        cfnet.FAC = self.timed('FAC', cfnet.FAC, lambda args, output: fac_flops(args, output))
+        if hasattr(self.model, 'drb_stage'):
+            self.model.drb_stage = self.timed('drb_stage', self.model.drb_stage)
+        return self
+
+    def stop(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        cfnet.FAC = self.originals.pop('FAC')
+        if 'drb_stage' in vars(self.model):
+            del self.model.drb_stage
+        if self.memory_profiler is not None:
+            self.memory_profiler.__exit__(None, None, None)
+            # net bytes allocated in each range, children included
+            allocated = {e.name: e.cpu_memory_usage for e in self.memory_profiler.events()
+                         if e.name.startswith('ModuleProfiler/')}
+            for event in self.events:
+                if 'range' in event:
+                    event['allocated'] = allocated.get(event.pop('range'), 0)
+            self.memory_profiler = None
+            self.ranges = {}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    # ---- reports ----
+
+    def aggregate(self):
+        """
+        per (name, phase): number of calls, total and mean milliseconds, GFLOPs, output MB and the
+        largest growth of allocated memory over one call in MB
+        """
+        summary = OrderedDict()
+        for event in sorted(self.events, key=lambda e: e['ts']):
+            entry = summary.setdefault((event['name'], event['phase']), {'calls': 0, 'ms': 0., 'gflops': 0.,
+                                                                         'mb': 0., 'alloc_mb': 0.})
+            entry['calls'] += 1
+            entry['ms'] += event['dur'] / 1e3
+            entry['gflops'] += event['flops'] / 1e9
+            entry['mb'] += event.get('bytes', 0) / 2 ** 20
+            entry['alloc_mb'] = max(entry['alloc_mb'], event.get('allocated', 0) / 2 ** 20)
+        return summary
+
+    def summary(self):
+        print('%-24s %-9s %6s %12s %10s %10s %10s %10s %11s' % ('module', 'phase', 'calls', 'total (ms)',
+                                                               'mean (ms)', 'GFLOPs', 'GFLOP/s', 'out (MB)',
+                                                               'alloc (MB)'))
+        for (name, phase), entry in self.aggregate().items():
+            print('%-24s %-9s %6d %12.2f %10.2f %10.3f %10.2f %10.1f %11.1f' % (
+                name, phase, entry['calls'], entry['ms'], entry['ms'] / entry['calls'], entry['gflops'],
+                entry['gflops'] / max(entry['ms'] / 1e3, 1e-9), entry['mb'], entry['alloc_mb']))
+
+    def export(self, path):
+        """
+        Chrome trace (chrome://tracing, Perfetto) of every call, forward and backward on separate rows,
+        with the per-module totals under otherData
+        """
+        trace = [{'name': event['name'], 'cat': event['phase'], 'ph': 'X', 'ts': event['ts'], 'dur': event['dur'],
+                  'pid': 0, 'tid': 0 if event['phase'] == 'forward' else 1,
+                  'args': {key: event[key] for key in ('flops', 'shapes', 'bytes', 'allocated') if key in event}}
+                 for event in self.events]
+        summary = [dict(name=name, phase=phase, **entry) for (name, phase), entry in self.aggregate().items()]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms', 'otherData': {'summary': summary}}, f)
+        print('===> Saved %s' % path)
+
+    def report(self, path):
+        self.summary()
+        self.export(path)
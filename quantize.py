@@ -0,0 +1,140 @@
+import os
+import cv2
+import copy
+import math
+import torch
+import random
+import inspect
+import numpy as np
+
+from option import args
+from utils import timeit, peak_memory
+from export import load_artifact, load_fusion_model, load_pairs
+from torch.ao.quantization import QConfig, get_default_qconfig
+from torch.ao.quantization.observer import MinMaxObserver
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+
+def quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    raise RuntimeError('[ERROR] this PyTorch build has no quantized CPU engine')
+
+
+def qconfig_dict(engine):
+    """
+    int8 activations with histogram observers and per-channel int8 convolution weights. The
+    quantized ConvTranspose2d and PReLU only take per-tensor weights
+    """
+    qconfig = get_default_qconfig(engine)
+    per_tensor = QConfig(activation=qconfig.activation,
+                         weight=MinMaxObserver.with_args(dtype=torch.qint8, qscheme=torch.per_tensor_symmetric))
+    return {'': qconfig, 'object_type': [(torch.nn.ConvTranspose2d, per_tensor), (torch.nn.PReLU, per_tensor)]}
+
+
+def calibration_pairs():
+    """
+    args.quant_calib pairs of dir_val, or a random sample of dir_train if there is no validation set
+    """
+    data_dir = args.dir_val
+    if args.quant_data == 'train' or not os.path.isdir(data_dir + 'lr_over/'):
+        if args.quant_data == 'val':
+            print('[WARNING] no validation pairs in %s, calibrating on %s' % (args.dir_val, args.dir_train))
+        data_dir = args.dir_train
+        num_imgs = len(os.listdir(data_dir + 'lr_over/'))
+        indices = sorted(random.Random(args.seed).sample(range(num_imgs), min(args.quant_calib, num_imgs)))
+        return load_pairs(data_dir, torch.device('cpu'), indices=indices)
+    return load_pairs(data_dir, torch.device('cpu'), args.quant_calib)
+
+
+def quantize_model(model, pairs):
+    """
+    static post-training quantization of a float FusionModel: FX traces it, fuses what it can, observes
+    the activations over the calibration pairs and converts to int8. FAC and the output mapping are
+    graph leaves (see model.py) and run in float between a dequantize and the next quantize
+    """
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+    qconfig = qconfig_dict(engine)
+    if 'example_inputs' in inspect.signature(prepare_fx).parameters:
+        prepared = prepare_fx(model, qconfig, example_inputs=pairs[0])
+    else:
+        prepared = prepare_fx(model, qconfig)
+    with torch.no_grad():
+        for lr_over, lr_under in pairs:
+            prepared(lr_over, lr_under)
+    return convert_fx(prepared)
+
+
+def calc_psnr(img1, img2):
+    mse = torch.mean((img1.float().clamp(0, 255).floor() / 255. - img2.float().clamp(0, 255).floor() / 255.) ** 2)
+    return 20 * math.log10(1. / math.sqrt(max(mse.item(), 1e-12)))
+
+
+def quantize():
+    """
+    write an int8 TorchScript artifact of args.model for CPU inference (Test --artifact), and report its
+    PSNR against the ground truth of dir_val, latency and memory next to the fp32 model
+    """
+    device = torch.device('cpu')
+    model = load_fusion_model(device).to(memory_format=torch.contiguous_format)
+    pairs = calibration_pairs()
+    print('===> Calibrating on %d pairs' % len(pairs))
+    quantized = quantize_model(copy.deepcopy(model), pairs)
+
+    path = os.path.splitext(args.model_path + args.model)[0] + '.int8.pt'
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(quantized, pairs[0]))
+    traced.save(path)
+    artifact = load_artifact(path, device)
+
+    # quality is measured against the ground truth of dir_val, dir_test has none
+    eval_dir = args.dir_val
+    if not os.path.isdir(eval_dir + 'gt/'):
+        print('[WARNING] no ground truth in %s, comparing int8 with fp32 on %s only' % (args.dir_val, args.dir_test))
+        eval_dir = args.dir_test
+    pairs = load_pairs(eval_dir, device, args.export_check)
+    gts = [None] * len(pairs)
+    if eval_dir == args.dir_val:
+        gts = [torch.from_numpy(cv2.imread(eval_dir + 'gt/' + name)).permute(2, 0, 1).unsqueeze(0)
+               for name in sorted(os.listdir(eval_dir + 'gt/'))[:len(pairs)]]
+    psnr, fp32_time, int8_time, fp32_peak, int8_peak = [], [], [], [], []
+    with torch.no_grad():
+        for pair, gt in zip(pairs, gts):
+            fused, peak = peak_memory(lambda: model(*pair), device)
+            fp32_peak.append(peak)
+            fused_int8, peak = peak_memory(lambda: artifact(*pair), device)
+            int8_peak.append(peak)
+            # both are written as uint8, compare what would be written
+            if gt is not None and gt.shape == fused.shape:
+                psnr.append((calc_psnr(fused, gt), calc_psnr(fused_int8, gt)))
+            elif gt is None:
+                psnr.append((float('nan'), calc_psnr(fused_int8, fused)))
+            else:
+                print('[WARNING] ground truth of size %s does not match the output %s, skipped'
+                      % (tuple(gt.shape[2:]), tuple(fused.shape[2:])))
+            fp32_time.append(timeit(lambda: model(*pair), device, warmup=1, repeat=3))
+            int8_time.append(timeit(lambda: artifact(*pair), device, warmup=1, repeat=3))
+
+    fp32_size = sum(p.numel() * p.element_size() for p in model.parameters())
+    print('%-24s %12s %12s' % ('', 'fp32', 'int8'))
+    print('%-24s %10.1f ms %10.1f ms   %.2fx' % ('latency', np.mean(fp32_time) * 1e3, np.mean(int8_time) * 1e3,
+                                                  np.mean(fp32_time) / np.mean(int8_time)))
+    print('%-24s %9.1f MiB %9.1f MiB' % ('peak activations', max(fp32_peak) / 2 ** 20, max(int8_peak) / 2 ** 20))
+    print('%-24s %9.1f MiB %9.1f MiB' % ('weights / artifact', fp32_size / 2 ** 20, os.path.getsize(path) / 2 ** 20))
+    if eval_dir == args.dir_val and psnr:
+        fp32_psnr, int8_psnr = np.mean(psnr, axis=0)
+        delta = [p[1] - p[0] for p in psnr]
+        print('%-24s %9.2f dB %9.2f dB   delta %.2f dB (worst %.2f dB) over %d pairs'
+              % ('PSNR against gt', fp32_psnr, int8_psnr, np.mean(delta), np.min(delta), len(psnr)))
+    elif psnr:
+        int8_psnr = [p[1] for p in psnr]
+        print('PSNR of int8 against fp32 output: %.2f dB (min %.2f dB) over %d pairs' % (
+            np.mean(int8_psnr), np.min(int8_psnr), len(psnr)))
+    print('===> Saved %s' % path)
+
+
+if __name__ == '__main__':
+    quantize()
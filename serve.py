@@ -0,0 +1,335 @@
+import os
+import cv2
+import json
+import time
+import torch
+import socket
+import mimetypes
+import threading
+import socketserver
+import numpy as np
+import torchvision.transforms as transforms
+
+from email import policy
+from email.parser import BytesParser
+from collections import deque, Counter
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from option import args
+from export import load_replica
+
+# number of most recent requests the latency percentiles are taken over
+LATENCY_WINDOW = 10000
+
+
+def percentiles(values):
+    """
+    mean, p50 and p99 in milliseconds
+    """
+    if not values:
+        return {'mean': None, 'p50': None, 'p99': None}
+    values = np.array(values) * 1e3
+    return {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+            'p99': float(np.percentile(values, 99))}
+
+
+class Metrics(object):
+    """
+    counters of the service and the latencies of its latest LATENCY_WINDOW requests and batches
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batch_sizes = Counter()
+        self.max_queue_depth = 0
+        # end to end in the handler: decoding, queueing, the model and encoding
+        self.latency = deque(maxlen=LATENCY_WINDOW)
+        self.queue_wait = deque(maxlen=LATENCY_WINDOW)
+        self.batch_time = deque(maxlen=LATENCY_WINDOW)
+
+    def queued(self, depth):
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def batch(self, size, waits, batch_time):
+        with self.lock:
+            self.batch_sizes[size] += 1
+            self.queue_wait.extend(waits)
+            self.batch_time.append(batch_time)
+
+    def request(self, latency, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            if not error:
+                self.latency.append(latency)
+
+    def snapshot(self, queue_depth):
+        with self.lock:
+            batches = sum(self.batch_sizes.values())
+            return {'uptime_s': time.time() - self.start_time, 'requests': self.requests, 'errors': self.errors,
+                    'queue_depth': queue_depth, 'max_queue_depth': self.max_queue_depth, 'batches': batches,
+                    'mean_batch_size': sum(k * v for k, v in self.batch_sizes.items()) / max(batches, 1),
+                    'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                    'latency_ms': percentiles(list(self.latency)),
+                    'queue_wait_ms': percentiles(list(self.queue_wait)),
+                    'batch_ms': percentiles(list(self.batch_time))}
+
+
+class Request(object):
+    def __init__(self, img1, img2):
+        self.img1 = img1
+        self.img2 = img2
+        self.arrival = time.perf_counter()
+        self.future = Future()
+
+
+class DynamicBatcher(object):
+    """
+    queue of fusion requests served in batches of one shape by one thread per model replica
+
+    A bucket is fused as soon as it holds max_batch pairs or its oldest pair has waited max_latency
+    seconds, whichever comes first, the oldest bucket goes first. A replica that becomes free takes
+    the next batch, so with several replicas a batch waits only while they are all busy.
+    """
+
+    def __init__(self, replicas, max_batch, max_latency):
+        self.max_batch = max(max_batch, 1)
+        self.max_latency = max_latency
+        self.buckets = {}
+        self.pending = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.metrics = Metrics()
+        self.threads = [threading.Thread(target=self.work, args=(fuse,), name='replica%d' % k, daemon=True)
+                        for k, fuse in enumerate(replicas)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, img1, img2):
+        """
+        queue a CHW pair, returns a Future of the fused CHW float array
+        """
+        request = Request(img1, img2)
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('[ERROR] the fusion service is shutting down')
+            self.buckets.setdefault(tuple(img1.shape), deque()).append(request)
+            self.pending += 1
+            self.metrics.queued(self.pending)
+            self.cond.notify_all()
+        return request.future
+
+    def next_batch(self):
+        with self.cond:
+            while not self.closed:
+                if not self.buckets:
+                    self.cond.wait()
+                    continue
+                full = [shape for shape, queue in self.buckets.items() if len(queue) >= self.max_batch]
+                if full:
+                    shape = full[0]
+                else:
+                    shape = min(self.buckets, key=lambda s: self.buckets[s][0].arrival)
+                    wait = self.buckets[shape][0].arrival + self.max_latency - time.perf_counter()
+                    if wait > 0:
+                        self.cond.wait(wait)
+                        continue
+                queue = self.buckets[shape]
+                batch = [queue.popleft() for _ in range(min(len(queue), self.max_batch))]
+                if not queue:
+                    del self.buckets[shape]
+                self.pending -= len(batch)
+                return batch
+            return None
+
+    def work(self, fuse):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            start_time = time.perf_counter()
+            try:
+                fused = fuse(torch.stack([request.img1 for request in batch]),
+                             torch.stack([request.img2 for request in batch]))
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            self.metrics.batch(len(batch), [start_time - request.arrival for request in batch],
+                               time.perf_counter() - start_time)
+            for request, img in zip(batch, fused):
+                request.future.set_result(img)
+
+    def snapshot(self):
+        with self.cond:
+            depth = self.pending
+        return self.metrics.snapshot(depth)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            for queue in self.buckets.values():
+                for request in queue:
+                    request.future.set_exception(RuntimeError('[ERROR] the fusion service is shutting down'))
+            self.buckets = {}
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+def read_pair(headers, body):
+    """
+    the BGR uint8 HWC pair of a /fuse request and whether it came as raw arrays: either
+    multipart/form-data with encoded images in the fields over and under, or application/octet-stream
+    with the raw over then under arrays and their size in the X-Shape header as height,width
+    """
+    content_type = headers.get('Content-Type', '')
+    if content_type.startswith('application/octet-stream'):
+        try:
+            h, w = [int(v) for v in headers.get('X-Shape', '').split(',')]
+        except ValueError:
+            raise ValueError('[ERROR] raw pairs need an X-Shape: height,width header')
+        if len(body) != 2 * h * w * 3:
+            raise ValueError('[ERROR] expected 2 x %d x %d x 3 bytes, got %d' % (h, w, len(body)))
+        # writable, the arrays become tensors
+        pair = np.frombuffer(body, dtype=np.uint8).reshape(2, h, w, 3).copy()
+        return pair[0], pair[1], True
+
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        fields = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                  for part in message.iter_parts()}
+        if 'over' not in fields or 'under' not in fields:
+            raise ValueError('[ERROR] multipart requests need the fields over and under')
+        imgs = [cv2.imdecode(np.frombuffer(fields[name], dtype=np.uint8), cv2.IMREAD_COLOR)
+                for name in ('over', 'under')]
+        if imgs[0] is None or imgs[1] is None:
+            raise ValueError('[ERROR] could not decode the images')
+        return imgs[0], imgs[1], False
+
+    raise ValueError('[ERROR] content type [%s] is not supported' % content_type)
+
+
+class FusionHandler(BaseHTTPRequestHandler):
+    """
+    POST /fuse fuses a pair (see read_pair), answering with the fused image encoded as --ext or raw
+    like the request. GET /metrics returns the service metrics as JSON, GET /health returns ok
+    """
+    protocol_version = 'HTTP/1.1'
+    transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=[0.5, 0.5, 0.5],
+                                                                                std=[0.5, 0.5, 0.5])])
+
+    def send(self, code, body, content_type, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, obj):
+        self.send(code, json.dumps(obj).encode(), 'application/json')
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.server.batcher.snapshot())
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        start_time = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/fuse':
+            self.send_json(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            img1, img2, raw = read_pair(self.headers, body)
+            if img1.shape != img2.shape:
+                raise ValueError('[ERROR] the exposures differ in size, %s and %s' % (img1.shape, img2.shape))
+        except ValueError as e:
+            self.server.batcher.metrics.request(0, error=True)
+            self.send_json(400, {'error': str(e)})
+            return
+
+        try:
+            fused = self.server.batcher.submit(self.transform(img1), self.transform(img2)).result()
+        except Exception as e:
+            self.server.batcher.metrics.request(0, error=True)
+            self.send_json(500, {'error': str(e)})
+            return
+        # as Test.save writes it
+        img_fused = np.clip(np.transpose(fused, (1, 2, 0)), 0, 255).astype(np.uint8)
+        if raw:
+            self.send(200, np.ascontiguousarray(img_fused).tobytes(), 'application/octet-stream',
+                      {'X-Shape': '%d,%d' % img_fused.shape[:2]})
+        else:
+            _, encoded = cv2.imencode(args.ext, img_fused)
+            self.send(200, encoded.tobytes(), mimetypes.guess_type('fused' + args.ext)[0] or 'application/octet-stream')
+        self.server.batcher.metrics.request(time.perf_counter() - start_time)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else args.socket
+
+    def log_message(self, format, *log_args):
+        if args.debug:
+            BaseHTTPRequestHandler.log_message(self, format, *log_args)
+
+
+class FusionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class UnixFusionServer(FusionServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def serve():
+    """
+    keep --serve_replicas models warm and fuse the pairs posted to /fuse on --host:--port, or on the
+    Unix socket --socket, in dynamic batches of up to --max_batch pairs of one shape, waiting at most
+    --max_latency ms for a batch to fill
+
+        curl -F over=@lr_over/1.png -F under=@lr_under/1.png -o fused.png localhost:8000/fuse
+        curl localhost:8000/metrics
+
+    The replicas share the intra-op threads of the process, more than one pays off on several GPUs
+    or with few threads each (--num_threads)
+    """
+    replicas = [load_replica(k) for k in range(max(args.serve_replicas, 1))]
+    batcher = DynamicBatcher(replicas, args.max_batch, args.max_latency / 1e3)
+    if args.socket:
+        server = UnixFusionServer(args.socket, FusionHandler)
+        print('===> Serving %d replicas on %s' % (len(replicas), args.socket))
+    else:
+        server = FusionServer((args.host, args.port), FusionHandler)
+        print('===> Serving %d replicas on http://%s:%d' % (len(replicas), args.host, server.server_port))
+    server.batcher = batcher
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    serve()
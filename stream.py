@@ -0,0 +1,178 @@
+import os
+import sys
+import cv2
+import time
+import torch
+import numpy as np
+import torchvision.transforms as transforms
+
+from tqdm import tqdm
+from option import args
+from pipeline import background, AsyncWriter
+from export import load_replica
+
+
+def video_pairs(capture, first):
+    """
+    (over, under) of every two consecutive frames of an alternating capture
+    """
+    try:
+        while True:
+            ok, frame1 = capture.read()
+            if not ok:
+                return
+            ok, frame2 = capture.read()
+            if not ok:
+                print('[WARNING] odd number of frames, the last one has no pair', file=sys.stderr)
+                return
+            yield (frame1, frame2) if first == 'over' else (frame2, frame1)
+    finally:
+        capture.release()
+
+
+def directory_pairs(path, over_imgs, under_imgs):
+    for over, under in zip(over_imgs, under_imgs):
+        yield cv2.imread(path + 'lr_over/' + over), cv2.imread(path + 'lr_under/' + under)
+
+
+def open_pairs(path, first):
+    """
+    the frame pairs of --stream_input, read lazily, with their frame rate (0 if unknown) and number
+    (0 if unknown)
+    """
+    if os.path.isdir(os.path.join(path, 'lr_over')):
+        path = os.path.join(path, '')
+        over_imgs = sorted(os.listdir(path + 'lr_over/'))
+        under_imgs = sorted(os.listdir(path + 'lr_under/'))
+        assert len(over_imgs) == len(under_imgs)
+        return directory_pairs(path, over_imgs, under_imgs), 0, len(over_imgs)
+
+    # video containers and printf-style image sequences alike
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError('[ERROR] cannot read frames from %s' % path)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    return video_pairs(capture, first), fps / 2 if fps > 0 else 0, max(num_frames, 0) // 2
+
+
+class FrameSink(object):
+    """
+    writes fused frames to a video through cv2.VideoWriter, or as raw bgr24 frames to a .raw file or
+    to stdout ('-'). Opened with the size of the first frame, which all others must have
+    """
+
+    def __init__(self, path, fps, fourcc):
+        self.path = path
+        self.fps = fps
+        self.fourcc = fourcc
+        self.raw = path == '-' or path.endswith('.raw')
+        self.out = None
+        self.shape = None
+
+    def open(self, shape):
+        h, w = shape[:2]
+        if self.raw:
+            # the real stdout, main.py sends sys.stdout to stderr while frames are streamed
+            self.out = sys.__stdout__.buffer if self.path == '-' else open(self.path, 'wb')
+            print('===> Raw bgr24 frames of %dx%d at %.2f fps' % (w, h, self.fps), file=sys.stderr)
+        else:
+            self.out = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (w, h))
+            if not self.out.isOpened():
+                raise ValueError('[ERROR] cannot write a %s video to %s' % (self.fourcc, self.path))
+        self.shape = shape
+
+    def write(self, frame):
+        if self.shape is None:
+            self.open(frame.shape)
+        elif frame.shape != self.shape:
+            raise ValueError('[ERROR] frame size changed from %s to %s, a stream keeps one size' % (
+                self.shape, frame.shape))
+        if self.raw:
+            self.out.write(np.ascontiguousarray(frame).tobytes())
+        else:
+            self.out.write(frame)
+
+    def close(self):
+        if self.out is None:
+            return
+        if not self.raw:
+            self.out.release()
+        elif self.path == '-':
+            self.out.flush()
+        else:
+            self.out.close()
+
+
+class Stream:
+    """
+    fuses a sequence of exposure pairs into one output stream: the frames are decoded and normalized
+    on a producer thread, fused in batches of --stream_batch consecutive pairs and converted and
+    written in order on a writer thread. The queues in between hold at most --prefetch_depth pairs
+    and --write_depth batches, so memory does not grow with the length of the sequence.
+    """
+
+    def __init__(self):
+        self.transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=[0.5, 0.5, 0.5],
+                                                                                         std=[0.5, 0.5, 0.5])])
+        self.pairs, fps, self.num_pairs = open_pairs(args.stream_input, args.stream_first)
+        self.fuse = load_replica(0)
+        self.sink = FrameSink(args.stream_output, args.stream_fps or fps or 30, args.stream_fourcc)
+        # running totals only, nothing is kept per frame
+        self.frames = 0
+        self.model_time = 0.
+        self.warm_time = None
+
+    def prepare(self, pair):
+        return self.transform(pair[0]), self.transform(pair[1])
+
+    def write(self, img_fused):
+        for img in img_fused:
+            # as Test.save writes it
+            self.sink.write(np.clip(np.transpose(img, (1, 2, 0)), 0, 255).astype(np.uint8))
+
+    def run_batch(self, pairs, writer):
+        start_time = time.time()
+        img_fused = self.fuse(torch.stack([pair[0] for pair in pairs]), torch.stack([pair[1] for pair in pairs]))
+        end_time = time.time()
+        self.model_time += end_time - start_time
+        self.frames += len(pairs)
+        if self.warm_time is None:
+            # the first batch also pays for the shape-specific setup of the backend
+            self.warm_time = (end_time, self.frames)
+        writer.submit(self.write, img_fused)
+
+    def stream(self):
+        log = sys.stderr if self.sink.path == '-' else sys.stdout
+        start_time = time.time()
+        batch = []
+        try:
+            # a single writer thread keeps the frames in order
+            with torch.no_grad(), AsyncWriter(1, args.write_depth) as writer:
+                pairs_in = background(map(self.prepare, self.pairs), args.prefetch_depth)
+                for img1, img2 in tqdm(pairs_in, total=self.num_pairs or None, unit='frame', file=sys.stderr):
+                    if batch and batch[0][0].shape != img1.shape:
+                        self.run_batch(batch, writer)
+                        batch = []
+                    batch.append((img1, img2))
+                    if len(batch) == args.stream_batch:
+                        self.run_batch(batch, writer)
+                        batch = []
+                if batch:
+                    self.run_batch(batch, writer)
+        finally:
+            # finalizes the container of what was written, also when the stream breaks off
+            self.sink.close()
+        total_time = time.time() - start_time
+
+        if self.frames == 0:
+            print('[WARNING] no frame pairs in %s' % args.stream_input, file=log)
+            return
+        print('Fused %d frames in %.2f s: %.2f fps end to end, %.2f fps in the model.' % (
+            self.frames, total_time, self.frames / total_time, self.frames / self.model_time), file=log)
+        warm_end, warm_frames = self.warm_time
+        if self.frames > warm_frames:
+            print('Sustained: {:.2f} fps after the first batch.'.format(
+                (self.frames - warm_frames) / (start_time + total_time - warm_end)), file=log)
+        if self.sink.path != '-':
+            print('===> Saved %s' % self.sink.path, file=log)
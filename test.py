@@ -6,13 +6,18 @@ import torch.nn
 import numpy as np
 import torchvision.transforms as transforms
 
-from tqdm import trange
-from model import CFNet
+from tqdm import tqdm
+from contextlib import nullcontext
+from model import CFNet, FusionModel
 from option import args
+from pipeline import prefetch, AsyncWriter
+from profiling import ModuleProfiler
+from tiling import fuse_tiled, tile_size_for_budget
+from utils import get_device, memory_format, to_device, synchronize, autocast
 
 
 class Test:
-    def __init__(self):
+    def __init__(self, indices=None):
         self.transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=[0.5, 0.5, 0.5],
                                                                                          std=[0.5, 0.5, 0.5])])
         self.test_dir_pre = args.dir_test
@@ -22,42 +27,106 @@ class Test:
         self.under_imgs.sort()
         assert len(self.over_imgs) == len(self.under_imgs)
         self.num_imgs = len(self.over_imgs)
+        # the pairs test() fuses, all of them unless a batch fusion worker runs a shard
+        self.indices = range(self.num_imgs) if indices is None else list(indices)
 
-        self.model = CFNet().cuda()
-        self.state = torch.load(args.model_path + args.model)
-        self.model.load_state_dict(self.state['model'])
+        self.device = get_device()
+        if args.artifact:
+            # exported graphs run as traced, in fp32 and without autocast
+            from export import load_artifact
+            self.model = load_artifact(args.artifact, self.device)
+        else:
+            model = CFNet()
+            self.state = torch.load(args.model_path + args.model, map_location='cpu')
+            model.load_state_dict(self.state['model'])
+            self.model = FusionModel(model).to(self.device, memory_format=memory_format(self.device))
+            self.model.eval()
+        if self.device.type == 'cuda' and args.test_batch_size > 1:
+            # keep the conv algorithm choice independent of the batch size
+            torch.backends.cudnn.benchmark = False
+            torch.backends.cudnn.deterministic = True
+
+        self.tile_size = args.tile_size
+        if self.tile_size == 0 and args.tile_memory > 0:
+            self.tile_size = tile_size_for_budget(self.fuse, self.device, args.tile_memory * 2 ** 20,
+                                                  args.tile_overlap)
+            print('===> Tiled inference with %d px tiles' % self.tile_size)
 
         self.test_time = []
 
-    def test(self):
-        self.model.eval()
-        with torch.no_grad():
-            for idx in trange(self.num_imgs):
-                img1 = cv2.imread(self.test_dir_pre + 'lr_over/' + self.over_imgs[idx])
-                img1 = torch.unsqueeze(self.transform(img1), 0)
-                img2 = cv2.imread(self.test_dir_pre + 'lr_under/' + self.under_imgs[idx])
-                img2 = torch.unsqueeze(self.transform(img2), 0)
+    def fuse(self, img1, img2):
+        img1 = to_device(img1, self.device)
+        img2 = to_device(img2, self.device)
+        with autocast(self.device, enabled=not args.artifact):
+            return self.model(img1, img2).to(self.device)
+
+    def load_pair(self, idx):
+        img1 = self.transform(cv2.imread(self.test_dir_pre + 'lr_over/' + self.over_imgs[idx]))
+        img2 = self.transform(cv2.imread(self.test_dir_pre + 'lr_under/' + self.under_imgs[idx]))
+
+        assert img1.shape == img2.shape
+        save_name = os.path.splitext(os.path.split(self.over_imgs[idx])[1])[0]
+        return img1, img2, save_name
 
-                assert img1.shape == img2.shape
-                save_name = os.path.splitext(os.path.split(self.over_imgs[idx])[1])[0]
+    def save(self, img_fused, save_name):
+        img_fused = np.transpose(img_fused, (1, 2, 0))
+        img_fused = np.clip(img_fused, 0, 255).astype(np.uint8)
 
-                img1 = img1.cuda()
-                img2 = img2.cuda()
-                torch.cuda.synchronize()
-                start_time = time.time()
+        cv2.imwrite(os.path.join(args.save_dir, str(save_name) + args.ext), img_fused)
 
-                sr_over, sr_under = self.model(img1, img2)
-                img_fused = 0.5 * sr_over[-1] + 0.5 * sr_under[-1]
-                img_fused = img_fused.squeeze(0)
+    def run_batch(self, pairs, writer):
+        img1 = torch.stack([pair[0] for pair in pairs])
+        img2 = torch.stack([pair[1] for pair in pairs])
 
-                torch.cuda.synchronize()
-                end_time = time.time()
-                self.test_time.append(end_time - start_time)
+        if self.tile_size > 0:
+            synchronize(self.device)
+            start_time = time.time()
+            img_fused = fuse_tiled(self.fuse, img1, img2, args.scale, self.tile_size, args.tile_overlap)
+        else:
+            img1 = to_device(img1, self.device)
+            img2 = to_device(img2, self.device)
+            synchronize(self.device)
+            start_time = time.time()
+            img_fused = self.fuse(img1, img2)
 
-                img_fused = img_fused.cpu().numpy()
-                img_fused = np.transpose(img_fused, (1, 2, 0))
-                img_fused = img_fused.astype(np.uint8)
+        synchronize(self.device)
+        end_time = time.time()
+        self.test_time.extend([(end_time - start_time) / len(pairs)] * len(pairs))
 
-                cv2.imwrite(os.path.join(args.save_dir, str(save_name) + args.ext), img_fused)
+        img_fused = img_fused.cpu().numpy()
+        for img, (_, _, save_name) in zip(img_fused, pairs):
+            writer.submit(self.save, img, save_name)
+
+    def run(self, indices, progress=True, profiler=None):
+        """
+        fuse and write the pairs of `indices`, returns the wall time
+        """
+        # pairs are batched with others of the same size only, a batch holds exactly what
+        # batch size 1 would have computed
+        buckets = {}
+        start_time = time.time()
+        # decoding, the model and encoding overlap, each bounded queue blocks its producer when full
+        pairs_in = prefetch(self.load_pair, indices, args.decode_threads, args.prefetch_depth)
+        with torch.no_grad(), AsyncWriter(args.encode_threads, args.write_depth) as writer, \
+                profiler or nullcontext():
+            for img1, img2, save_name in tqdm(pairs_in, total=len(indices), disable=not progress):
+                shape = tuple(img1.shape)
+                buckets.setdefault(shape, []).append((img1, img2, save_name))
+                if len(buckets[shape]) == args.test_batch_size:
+                    self.run_batch(buckets.pop(shape), writer)
+            for pairs in buckets.values():
+                self.run_batch(pairs, writer)
+        return time.time() - start_time
+
+    def test(self):
+        # --profile records the CFNet blocks of every pair, exported traces are opaque to it
+        profiler = None
+        if args.profile and not args.artifact:
+            profiler = ModuleProfiler(self.model.model, depth=args.profile_depth)
+        total_time = self.run(self.indices, profiler=profiler)
+        if profiler is not None:
+            profiler.report(args.profile_trace)
 
-            print('The average testing time is {:.4f} s.'.format(np.mean(self.test_time)))
+        print('The average testing time is {:.4f} s.'.format(np.mean(self.test_time)))
+        print('Throughput: {:.2f} images/s in the model, {:.2f} images/s end to end.'.format(
+            len(self.indices) / np.sum(self.test_time), len(self.indices) / total_time))
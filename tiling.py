@@ -0,0 +1,82 @@
+import math
+import torch
+
+from utils import peak_memory
+
+
+def tile_starts(length, tile_size, overlap):
+    """
+    origins of the tiles covering [0, length), the last one is shifted back to end on the border
+    """
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+
+def blend_window(length, ramp, at_start, at_end):
+    """
+    1-D weights that fade linearly over `ramp` pixels on every side shared with a neighbouring tile
+    """
+    window = torch.ones(length)
+    ramp = min(ramp, length // 2)
+    if ramp > 0:
+        fade = (torch.arange(ramp, dtype=torch.float32) + 0.5) / ramp
+        if not at_start:
+            window[:ramp] = fade
+        if not at_end:
+            window[-ramp:] = torch.min(window[-ramp:], fade.flip(0))
+    return window
+
+
+def fuse_tiled(fuse, lr_over, lr_under, scale, tile_size, overlap):
+    """
+    run fuse(lr_over_tile, lr_under_tile) -> fused HR tile over overlapping LR tiles and blend the results
+
+    Tiles are cut on the LR grid, so every HR tile starts on a multiple of `scale`: the stride-2 feature0
+    path of the DRB and the stride-`scale` projections in SRB/CFB see the same sampling phase as the
+    whole image would. The inputs stay where they are (typically on the CPU), only one tile at a time
+    is handed to `fuse`.
+    """
+    N, _, H, W = lr_over.size()
+    if tile_size <= 2 * overlap:
+        raise ValueError('[ERROR] tile size %d must be larger than twice the overlap %d' % (tile_size, overlap))
+
+    fused = None
+    weight = lr_over.new_zeros(1, 1, H * scale, W * scale)
+    for y in tile_starts(H, tile_size, overlap):
+        th = min(tile_size, H)
+        wy = blend_window(th * scale, overlap * scale, y == 0, y + th == H)
+        for x in tile_starts(W, tile_size, overlap):
+            tw = min(tile_size, W)
+            wx = blend_window(tw * scale, overlap * scale, x == 0, x + tw == W)
+
+            tile = fuse(lr_over[:, :, y:y + th, x:x + tw], lr_under[:, :, y:y + th, x:x + tw])
+            tile = tile.to(lr_over.device, torch.float32)
+            if fused is None:
+                fused = lr_over.new_zeros(N, tile.size(1), H * scale, W * scale)
+
+            w = (wy[:, None] * wx[None, :]).to(lr_over.device)
+            region = (slice(None), slice(None), slice(y * scale, (y + th) * scale), slice(x * scale, (x + tw) * scale))
+            fused[region] += tile * w
+            weight[region] += w
+
+    return fused / weight
+
+
+def tile_size_for_budget(fuse, device, budget, overlap, probe=64, align=8):
+    """
+    largest aligned LR tile whose forward stays within `budget` bytes, measured on a probe tile
+
+    Activation memory is linear in the pixel count, the fixed overhead of the probe only makes the
+    estimate more conservative.
+    """
+    x = torch.zeros(1, 3, probe, probe)
+    with torch.no_grad():
+        _, peak = peak_memory(lambda: fuse(x, x), device)
+    per_pixel = max(peak, 1) / (probe * probe)
+    tile_size = int(math.sqrt(budget / per_pixel)) // align * align
+    if tile_size <= 2 * overlap:
+        raise ValueError('[ERROR] a %.0f MB budget only fits %d px tiles, too small for a %d px overlap'
+                         % (budget / 2 ** 20, tile_size, overlap))
+    return tile_size
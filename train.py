@@ -1,164 +1,344 @@
 import os
 import cv2
-import math
+import time
 import torch
 import random
-import matplotlib
 import torch.nn
+import torch.nn.functional as F
 import numpy as np
 import torch.utils.data as data
-import torchvision.transforms as transforms
-import matplotlib.pyplot as plt
+import torch.distributed as dist
 
 from tqdm import tqdm
-from tqdm import trange
 from option import args
 from model import CFNet
 from torch.optim import Adam, lr_scheduler
-from dataset import MEFdataset
+from torch.nn.parallel import DistributedDataParallel
+from dataset import MEFdataset, MEFmmapDataset, EpochSampler, collate_uint8
 from pytorch_msssim import ssim, ms_ssim, SSIM, MS_SSIM
 from perceived_loss import PerceptualLoss
+from checkpoints import CheckpointWriter, rng_state, set_rng_state
+from profiling import ModuleProfiler
+from utils import get_device, memory_format, to_device, autocast, grad_scaler, world_size, rank, is_main_process
+
+def ssim_fp32(img1, img2):
+    """
+    SSIM of images in [0, 255], kept in fp32 under autocast: the local variances are differences of
+    large second moments and cancel badly in half precision
+    """
+    with autocast(img1.device, enabled=False):
+        return ssim(img1.float(), img2.float(), win_size=7, nonnegative_ssim=True)
+
+
+def gaussian_filter(x, win):
+    """
+    separable depthwise Gaussian blur without padding, as pytorch_msssim filters, dimensions smaller
+    than the window are left unfiltered. The batch is folded into the channels: one image of N * C
+    groups runs much faster than N images of C groups on the mkldnn depthwise kernels
+    """
+    batch_size, channels = x.shape[:2]
+    x = x.reshape(1, batch_size * channels, *x.shape[2:])
+    weight = win.view(1, 1, 1, -1).expand(x.size(1), 1, 1, -1)
+    for dim in (2, 3):
+        if x.size(dim) >= win.numel():
+            x = F.conv2d(x, weight.transpose(dim, 3), groups=x.size(1))
+    return x.view(batch_size, channels, *x.shape[2:])
+
+
+def multi_ssim(preds, targets, index, win_size=7, win_sigma=1.5, data_range=255., K=(0.01, 0.03)):
+    """
+    ssim_fp32(preds[i], targets[index[i]]) for every i, as a tensor
+
+    All predictions go through one filtering pass for their means, second moments and cross terms,
+    and the statistics of each target are filtered once, without autograd, however many predictions
+    share it.
+    """
+    with autocast(preds[0].device, enabled=False):
+        coords = torch.arange(win_size, dtype=torch.float, device=preds[0].device) - win_size // 2
+        win = torch.exp(-(coords ** 2) / (2 * win_sigma ** 2))
+        win = win / win.sum()
+
+        with torch.no_grad():
+            t = torch.stack([target.float() for target in targets])
+            t_stats = gaussian_filter(torch.cat([t, t * t]).flatten(0, 1), win)
+            mu_t, tt = t_stats.view(2, *t.shape[:3], *t_stats.shape[2:]).unbind(0)
+        index = torch.as_tensor(index, device=t.device)
+        mu_t, tt, t = mu_t[index].flatten(0, 1), tt[index].flatten(0, 1), t[index].flatten(0, 1)
+
+        x = torch.stack([pred.float() for pred in preds]).flatten(0, 1)
+        mu_x, xx, xt = gaussian_filter(torch.cat([x, x * x, x * t]), win).chunk(3)
+
+        C1 = (K[0] * data_range) ** 2
+        C2 = (K[1] * data_range) ** 2
+        mu_x_sq = mu_x.pow(2)
+        mu_t_sq = mu_t.pow(2)
+        mu_xt = mu_x * mu_t
+        sigma_x_sq = xx - mu_x_sq
+        sigma_t_sq = tt - mu_t_sq
+        sigma_xt = xt - mu_xt
+        cs_map = (2 * sigma_xt + C2) / (sigma_x_sq + sigma_t_sq + C2)
+        ssim_map = ((2 * mu_xt + C1) / (mu_x_sq + mu_t_sq + C1)) * cs_map
+        ssim_per_channel = torch.relu(torch.flatten(ssim_map, 2).mean(-1))
+        return ssim_per_channel.view(len(preds), -1).mean(1)
+
+
+def fusion_loss(sr_over, sr_under, fusion, h_over, h_under, h, perceptual_loss):
+    # the first stage is compared with its own exposure, every later one with the fused ground truth
+    preds = [sr_over[0], sr_under[0]]
+    for j in range(len(sr_over) - 1):
+        preds += [sr_over[j + 1], sr_under[j + 1]]
+    index = [0, 1] + [2] * (len(preds) - 2)
+    loss = torch.sum(1.0 - multi_ssim(preds, [h_over, h_under, h], index))
+    loss += perceptual_loss(fusion, h)
+    return loss
+
 
 class Train(object):
     def __init__(self):
         # configurations
         self.epoch = 1000
         self.lr = 0.000001
-        
-        self.perceptualLoss = PerceptualLoss().cuda() 
-        # create loader
-        self.transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=[0.5, 0.5, 0.5],
-                                                                                         std=[0.5, 0.5, 0.5])])
-        self.train_set = MEFdataset(transform=self.transform)
-        self.train_loader = data.DataLoader(self.train_set, batch_size=args.batch_size, shuffle=True, num_workers=0)
-
-        # create model
-        self.model = CFNet().cuda()
+        self.device = get_device()
+
+        self.perceptualLoss = PerceptualLoss().to(self.device, memory_format=memory_format(self.device))
+        # create loader, samples stay uint8 until MEFBatch.to() normalizes the whole batch on the device
+        # with several patches per image a batch holds batch_size images, i.e. batch_size * K patches
+        if args.train_store:
+            self.train_set = MEFmmapDataset(transform=None)
+        else:
+            self.train_set = MEFdataset(transform=None)
+        # the generator drives the shuffling. Under torchrun every rank gets its share of the items from
+        # a DistributedSampler, which shuffles alike on all ranks. The crops are seeded per item from
+        # --seed, rank and epoch, which the EpochSampler hands the workers, see MEFdataset.seed_item
+        self.generator = torch.Generator()
+        self.generator.manual_seed(args.seed + rank())
+        # the worker base seeds come from their own generator, so that the loader does not draw from
+        # the shuffling one when its workers (re)start, as it does on a resume
+        worker_generator = torch.Generator()
+        worker_generator.manual_seed(args.seed + rank())
+        if world_size() > 1:
+            sampler = data.DistributedSampler(self.train_set, num_replicas=world_size(), rank=rank(),
+                                              shuffle=True, seed=args.seed, drop_last=True)
+        else:
+            sampler = data.RandomSampler(self.train_set, generator=self.generator)
+        self.sampler = EpochSampler(sampler)
+        loader_args = {}
+        if args.num_workers > 0:
+            loader_args = {'persistent_workers': True, 'prefetch_factor': args.prefetch_factor}
+        self.train_loader = data.DataLoader(self.train_set, batch_size=args.batch_size, sampler=self.sampler,
+                                            num_workers=args.num_workers, collate_fn=collate_uint8,
+                                            pin_memory=self.device.type == 'cuda', generator=worker_generator,
+                                            **loader_args)
+
+        # create model, trained through DistributedDataParallel under torchrun, each process then holds
+        # batch_size samples of the batch_size * world_size global batch
+        self.model = CFNet().to(self.device, memory_format=memory_format(self.device))
+        self.train_model = self.model
+        if world_size() > 1:
+            # feature1 is never used in the forward
+            self.train_model = DistributedDataParallel(
+                self.model, device_ids=[self.device.index] if self.device.type == 'cuda' else None,
+                find_unused_parameters=True)
         self.optimizer = Adam(self.model.parameters(), lr=self.lr)
         self.scheduler = lr_scheduler.StepLR(self.optimizer, step_size=200, gamma=0.5)
+        self.scaler = grad_scaler(self.device)
+        # rank 0 validates, checkpoints and plots
+        self.checkpoints = None
+        if is_main_process():
+            self.checkpoints = CheckpointWriter(args.model_path, args.save_interval, args.keep_last)
 
         self.Loss_list = []
-        if args.validation:
+        # epochs between validations, 0 when there is nothing to validate on
+        self.val_interval = 0
+        if args.validation and is_main_process():
+            self.validator = Validation()
             self.val_list = []
+            self.val_epochs = []
             self.best_psnr = 0
+            if self.validator.num_imgs > 0:
+                self.val_interval = args.val_interval
 
     def train(self):
+        start_epoch = 0
         if os.path.exists(args.model_path + args.model):
             print('===>Loading pre-trained model...')
-            state = torch.load(args.model_path + args.model)
+            # on the CPU, the RNG states must stay there and load_state_dict copies the rest to the device
+            state = torch.load(args.model_path + args.model, map_location='cpu')
             self.model.load_state_dict(state['model'])
             self.Loss_list = state['loss']
+            if 'epoch' in state:
+                # a full checkpoint, continue the run where it stopped
+                self.optimizer.load_state_dict(state['optimizer'])
+                self.scheduler.load_state_dict(state['scheduler'])
+                # a disabled scaler (fp32, bf16) saves an empty state
+                if state['scaler']:
+                    self.scaler.load_state_dict(state['scaler'])
+                # one state per rank, a single-process checkpoint holds a plain one
+                rng = state['rng'] if isinstance(state['rng'], list) else [state['rng']]
+                if len(rng) == world_size():
+                    set_rng_state(rng[rank()], self.generator)
+                else:
+                    print('[WARNING] checkpoint of %d processes, random streams restart' % len(rng))
+                if args.validation and is_main_process() and 'val' in state:
+                    self.val_list, self.val_epochs, self.best_psnr = state['val']
+                start_epoch = state['epoch'] + 1
+                print('===> Resuming at epoch %d' % start_epoch)
         else:
             self.Loss_list = []
 
-        bar = tqdm(range(1000))
+        # --profile records forward and backward of the first profile_steps steps
+        profiler = None
+        if args.profile and is_main_process():
+            profiler = ModuleProfiler(self.model, depth=args.profile_depth)
+        bar = tqdm(range(start_epoch, self.epoch), initial=start_epoch, total=self.epoch,
+                   disable=not is_main_process())
         for ep in bar:
+            self.sampler.set_epoch(ep)
             loss_list = []
             i = 0
-            for l_over, l_under, h_over, h_under, h in self.train_loader:
+            # time spent waiting for the loader, a high share means training is input-bound
+            load_time = 0
+            num_patches = 0
+            start_time = time.time()
+            load_start = time.time()
+            for batch in self.train_loader:
                 i = i + 1
-                h = (h + 1) * 127.5
-                h = h.cuda()
-                h_over = (h_over + 1) * 127.5
-                h_over = h_over.cuda()
-                h_under = (h_under + 1) * 127.5
-                h_under = h_under.cuda()
-
-                sr_over, sr_under, fusion= self.model(l_over.cuda(), l_under.cuda())
-
-                loss = - ssim(
-                    sr_over[0], h_over, win_size=7, nonnegative_ssim=True) - ssim(sr_under[0], h_under, win_size=7,
-                                                                                  nonnegative_ssim=True) + 2.0
-                num_CFBs = 3
-                for j in range(num_CFBs):
-                    loss += - ssim(sr_over[j + 1], h, win_size=7, nonnegative_ssim=True) - ssim(sr_under[j + 1], h,
-                                                                                                win_size=7,
-                                                                                             nonnegative_ssim=True) + 2.0
-                loss += self.perceptualLoss(fusion.cuda(),h.cuda())
-                
+                load_time += time.time() - load_start
+                if profiler is not None and ep == start_epoch and i == 1:
+                    profiler.start()
+                l_over, l_under, h_over, h_under, h = batch.to(self.device)
+                num_patches += l_over.size(0)
+
+                with autocast(self.device):
+                    sr_over, sr_under, fusion= self.train_model(l_over, l_under)
+                    loss = fusion_loss(sr_over, sr_under, fusion, h_over, h_under, h, self.perceptualLoss)
+
                 loss_list.append(loss.item())
-                bar.set_description("Epoch: %d    Loss: %.6f" % (ep, loss_list[-1]))
 
-                # update parameters
+                # update parameters, the scaler is only active for fp16
                 self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                if profiler is not None and profiler.handles and i == args.profile_steps:
+                    profiler.stop()
+                    profiler.report(args.profile_trace)
+
+                elapsed = time.time() - start_time
+                bar.set_description("Epoch: %d    Loss: %.6f    Load: %.0f%%    %.1f patches/s" % (
+                    ep, loss_list[-1], 100 * load_time / elapsed, num_patches / elapsed))
+                load_start = time.time()
+            if profiler is not None and profiler.handles:
+                # an epoch shorter than profile_steps
+                profiler.stop()
+                profiler.report(args.profile_trace)
             self.scheduler.step()
-            self.Loss_list.append(np.mean(loss_list))
+            epoch_loss = float(np.mean(loss_list))
+            if world_size() > 1:
+                epoch_loss = torch.tensor(epoch_loss, dtype=torch.float64, device=self.device)
+                dist.all_reduce(epoch_loss)
+                epoch_loss = epoch_loss.item() / world_size()
+            self.Loss_list.append(epoch_loss)
 
+            best = False
+            if self.val_interval > 0 and (ep + 1) % self.val_interval == 0:
+                psnr_value, ssim_value = self.validator.validation(self.model)
+                bar.write('===> Epoch %d validation PSNR: %.4f dB    SSIM: %.4f' % (ep, psnr_value, ssim_value))
+                self.val_list.append(psnr_value)
+                self.val_epochs.append(ep)
+                if psnr_value > self.best_psnr:
+                    self.best_psnr = psnr_value
+                    best = True
+
+            # everything an exact resume needs, the generator state covers the shuffling of the next epoch
+            # and the crops are seeded from the epoch, see MEFdataset.seed_item
+            rng = rng_state(self.generator)
+            if world_size() > 1:
+                rngs = [None] * world_size()
+                dist.all_gather_object(rngs, rng)
+                rng = rngs
+            if not is_main_process():
+                continue
             state = {
                 'model': self.model.state_dict(),
-                'loss': self.Loss_list
+                'loss': self.Loss_list,
+                'optimizer': self.optimizer.state_dict(),
+                'scheduler': self.scheduler.state_dict(),
+                'scaler': self.scaler.state_dict(),
+                'epoch': ep,
+                'rng': rng
             }
-
-            torch.save(state, os.path.join(args.model_path, 'latest.pth'))
-
-            if ep % 5 == 0:
-                model_name = str(ep) + '.pth'
-                torch.save(state, os.path.join(args.model_path, model_name))
-            matplotlib.use('Agg')
-            fig_train = plt.figure()
-            plt.plot(self.Loss_list)
-            plt.savefig('train_loss_curve.png')
             if args.validation:
-                Val = Validation()
-                psnr_value = Val.validation()
-                self.val_list.append(psnr_value)
-                if psnr_value > self.best_psnr:
-                    torch.save(state, os.path.join(args.model_path, 'best_ep.pth'))
-                    self.best_psnr = psnr_value
-                fig_val = plt.figure()
-                plt.plot(self.val_list)
-                plt.savefig('val_psnr_curve.png')
-            plt.close()
-        print("===> Finished Training!")
+                state['val'] = (self.val_list, self.val_epochs, self.best_psnr)
+
+            # written and plotted on the checkpoint thread, training goes on with the next epoch
+            self.checkpoints.save(state, ep, best)
+            self.checkpoints.plot(self.Loss_list, 'train_loss_curve.png')
+            if args.validation and self.val_epochs and self.val_epochs[-1] == ep:
+                self.checkpoints.plot(self.val_list, 'val_psnr_curve.png', self.val_epochs)
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+            print("===> Finished Training!")
 
 
 class Validation(object):
+    """
+    scores a model on dir_val, which is decoded once and kept on the device as uint8 batches of
+    pairs with the same size
+    """
+
     def __init__(self):
-        self.psnr_list = []
-        self.transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=[0.5, 0.5, 0.5],
-                                                                                         std=[0.5, 0.5, 0.5])])
         self.val_dir_pre = args.dir_val
-        self.gt_imgs = os.listdir(self.val_dir_pre + 'gt/')
-        self.over_imgs = os.listdir(self.val_dir_pre + 'lr_over/')
-        self.under_imgs = os.listdir(self.val_dir_pre + 'lr_under/')
-        assert len(self.over_imgs) == len(self.under_imgs)
-        self.num_imgs = len(self.over_imgs)
-
-        self.model = CFNet().cuda()
-        self.state = torch.load(args.model_path + 'latest.pth')
-        self.model.load_state_dict(self.state['model'])
-
-    def validation(self):
-        ep_psnr_list = []
-        self.model.eval()
+        self.gt_imgs = sorted(os.listdir(self.val_dir_pre + 'gt/'))
+        self.over_imgs = sorted(os.listdir(self.val_dir_pre + 'lr_over/'))
+        self.under_imgs = sorted(os.listdir(self.val_dir_pre + 'lr_under/'))
+        assert len(self.over_imgs) == len(self.under_imgs) == len(self.gt_imgs)
+        self.device = get_device()
+
+        buckets = {}
+        for idx in range(len(self.over_imgs)):
+            img1 = cv2.imread(self.val_dir_pre + 'lr_over/' + self.over_imgs[idx])
+            img2 = cv2.imread(self.val_dir_pre + 'lr_under/' + self.under_imgs[idx])
+            img_gt = cv2.imread(self.val_dir_pre + 'gt/' + self.gt_imgs[idx])
+            assert img1.shape == img2.shape
+            if img_gt.shape != (img1.shape[0] * args.scale, img1.shape[1] * args.scale, img1.shape[2]):
+                print('[WARNING] %s is not %d times the size of %s, skipped in validation'
+                      % (self.gt_imgs[idx], args.scale, self.over_imgs[idx]))
+                continue
+            buckets.setdefault(img1.shape, []).append((img1, img2, img_gt))
+        if not buckets:
+            print('[WARNING] no validation pair in %s matches its ground truth size, validation is disabled'
+                  % self.val_dir_pre)
+
+        self.batches = []
+        for pairs in buckets.values():
+            for start in range(0, len(pairs), args.val_batch_size):
+                chunk = pairs[start:start + args.val_batch_size]
+                self.batches.append(tuple(
+                    to_device(torch.from_numpy(np.stack([pair[k] for pair in chunk])).permute(0, 3, 1, 2), self.device)
+                    for k in range(3)))
+        self.num_imgs = sum(len(pairs) for pairs in buckets.values())
+
+    def validation(self, model):
+        """
+        mean PSNR and SSIM of the fused images, quantized to uint8 as Test writes them, against the
+        ground truth. model is left in the mode it came in
+        """
+        training = model.training
+        model.eval()
+        psnr_list = []
+        ssim_list = []
         with torch.no_grad():
-            for idx in trange(self.num_imgs):
-                img1 = cv2.imread(self.val_dir_pre + 'lr_over/' + self.over_imgs[idx])
-                img1 = torch.unsqueeze(self.transform(img1), 0)
-                img2 = cv2.imread(self.val_dir_pre + 'lr_under/' + self.under_imgs[idx])
-                img2 = torch.unsqueeze(self.transform(img2), 0)
-                img_gt = cv2.imread(self.val_dir_pre + 'gt/' + self.gt_imgs[idx])
-
-                assert img1.shape == img2.shape
-
-                img1 = img1.cuda()
-                img2 = img2.cuda()
-
-                sr_over, sr_under = self.model(img1, img2)
-                img_fused = 0.5 * sr_over[-1] + 0.5 * sr_under[-1]
-                img_fused = img_fused.squeeze(0)
-
-                img_fused = img_fused.cpu().numpy()
-                img_fused = np.transpose(img_fused, (1, 2, 0))
-                img_fused = img_fused.astype(np.uint8)
-
-                psnr_idx = self.calc_psnr(img_fused, img_gt)
-                ep_psnr_list.append(psnr_idx)
-        return np.mean(ep_psnr_list)
-
-    def calc_psnr(self, img1, img2):
-        mse = np.mean((img1 / 255. - img2 / 255.) ** 2)
-        pixel_max = 1.
-        return 20 * math.log10(pixel_max / math.sqrt(mse))
+            for lr_over, lr_under, gt in self.batches:
+                img1 = (lr_over.float() / 127.5 - 1).contiguous(memory_format=memory_format(self.device))
+                img2 = (lr_under.float() / 127.5 - 1).contiguous(memory_format=memory_format(self.device))
+                with autocast(self.device):
+                    sr_over, sr_under = model(img1, img2, outputs='sr')
+                img_fused = (0.5 * sr_over + 0.5 * sr_under).float().floor()
+                gt = gt.float()
+
+                mse = torch.mean(((img_fused - gt) / 255.) ** 2, dim=(1, 2, 3))
+                psnr_list.append(-10 * torch.log10(mse))
+                ssim_list.append(ssim(img_fused, gt, data_range=255, size_average=False))
+        model.train(training)
+        return torch.cat(psnr_list).mean().item(), torch.cat(ssim_list).mean().item()
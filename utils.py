@@ -0,0 +1,173 @@
+import os
+import time
+import torch
+import numpy as np
+import torch.distributed as dist
+
+from option import args
+
+_device = None
+
+
+def init_distributed():
+    """
+    join the process group torchrun describes in the environment (WORLD_SIZE, RANK, MASTER_ADDR, ...),
+    nothing to do for a single process
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not dist.is_initialized():
+        dist.init_process_group(backend=args.dist_backend)
+
+
+def world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def is_main_process():
+    return rank() == 0
+
+
+def get_device():
+    """
+    resolve --device once per process and tune the CPU backend
+    """
+    global _device
+    if _device is not None:
+        return _device
+
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if args.device == 'auto':
+        _device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    else:
+        _device = torch.device(args.device)
+    if _device.type == 'cuda' and _device.index is None and world_size() > 1:
+        # one GPU per process on the node
+        _device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(_device)
+
+    if _device.type == 'cpu':
+        num_threads = args.num_threads
+        if num_threads == 0 and world_size() > 1:
+            # the processes of a node share its cores, torchrun would leave each with a single thread
+            num_threads = max(1, (os.cpu_count() or 1) // int(os.environ.get('LOCAL_WORLD_SIZE', 1)))
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        if args.num_interop_threads > 0:
+            # only allowed before the first inter-op parallel region
+            try:
+                torch.set_num_interop_threads(args.num_interop_threads)
+            except RuntimeError:
+                print('[WARNING] inter-op threads already initialised, keeping %d' %
+                      torch.get_num_interop_threads())
+        # oneDNN kernels are picked for channels_last conv / deconv inputs
+        torch.backends.mkldnn.enabled = True
+    return _device
+
+
+def amp_dtype(device, precision=None):
+    """
+    autocast dtype for --precision on `device`, None for fp32
+    """
+    precision = precision or args.precision
+    if precision == 'fp32':
+        return None
+    if precision == 'fp16' and device.type == 'cpu':
+        # CPU autocast only has bf16 kernels
+        return torch.bfloat16
+    return torch.float16 if precision == 'fp16' else torch.bfloat16
+
+
+def autocast(device, precision=None, enabled=True):
+    """
+    autocast context for --precision, a no-op for fp32
+    """
+    dtype = amp_dtype(device, precision)
+    if dtype is None:
+        dtype = torch.bfloat16 if device.type == 'cpu' else torch.float16
+        enabled = False
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=enabled)
+
+
+def grad_scaler(device, precision=None):
+    """
+    loss scaler of CUDA fp16 training, disabled otherwise
+    """
+    enabled = amp_dtype(device, precision) == torch.float16
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    # torch < 2.3
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def memory_format(device):
+    return torch.channels_last if device.type == 'cpu' else torch.contiguous_format
+
+
+def to_device(tensor, device):
+    return tensor.to(device, memory_format=memory_format(device))
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn, device, warmup=2, repeat=10):
+    """
+    median wall time of fn() in seconds
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        synchronize(device)
+        start_time = time.time()
+        fn()
+        synchronize(device)
+        times.append(time.time() - start_time)
+    return float(np.median(times))
+
+
+def peak_memory(fn, device):
+    """
+    run fn() once and return its result and the peak bytes allocated on top of what was live before
+    """
+    if device.type == 'cuda':
+        synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        result = fn()
+        synchronize(device)
+        return result, torch.cuda.max_memory_allocated(device) - base
+
+    # the CPU allocator keeps no statistics, replay the per-op allocations recorded by the profiler
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        result = fn()
+    usage = peak = 0
+    for event in sorted(prof.events(), key=lambda e: e.time_range.start):
+        usage += event.self_cpu_memory_usage
+        peak = max(peak, usage)
+    return result, peak
+
+
+def allocations(fn, device):
+    """
+    number and total bytes of the allocations made by fn()
+    """
+    if device.type == 'cuda':
+        synchronize(device)
+        before = torch.cuda.memory_stats(device)
+        fn()
+        synchronize(device)
+        after = torch.cuda.memory_stats(device)
+        return (after['allocation.all.allocated'] - before['allocation.all.allocated'],
+                after['allocated_bytes.all.allocated'] - before['allocated_bytes.all.allocated'])
+
+    # on CPU count the ops that allocated, as recorded by the profiler
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    sizes = [e.self_cpu_memory_usage for e in prof.events() if e.self_cpu_memory_usage > 0]
+    return len(sizes), sum(sizes)